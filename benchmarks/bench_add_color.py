@@ -0,0 +1,101 @@
+"""Compare the vectorized utils.add_color with the original row-by-row version
+
+    python benchmarks/bench_add_color.py
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+import matplotlib as mpl
+from scipy.stats import boxcox
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import utils  # noqa: E402
+
+
+def legacy_get_opacity(df):
+    earliest_time = df.timestamp.min()
+    latest_time = df.timestamp.max()
+
+    if earliest_time == latest_time:
+        return [
+            255,
+        ]
+
+    max_range = (latest_time - earliest_time).total_seconds()
+
+    return [
+        int((((x - earliest_time).total_seconds() / max_range) ** 0.25) * 255)
+        for x in df.timestamp
+    ]
+
+
+def legacy_add_color(
+    df,
+    lambda_=0.3,
+    add_opacity=False,
+    color_map=mpl.colormaps["coolwarm"],
+):
+    if df.empty:
+        return df.assign(color=[])
+
+    data_normed = np.clip((boxcox(df.value, lambda_) + 2) / 8, 0, 1)
+
+    rgb_values = color_map(data_normed, bytes=True)
+
+    if not add_opacity:
+        return df.assign(color=[x.tolist() for x in rgb_values])
+
+    opacities = legacy_get_opacity(df)
+
+    for i, opacity in enumerate(opacities):
+        rgb_values[i, -1] = opacity
+
+    return df.assign(color=[x.tolist() for x in rgb_values])
+
+
+def make_frame(n, seed=0):
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2017-01-01T00:00:00")
+    seconds = np.sort(rng.integers(0, 6 * 365 * 24 * 3600, n))
+
+    return pd.DataFrame(
+        {
+            "timestamp": start + seconds.astype("timedelta64[s]"),
+            "value": rng.gamma(2.0, 10.0, n) + 0.1,
+        }
+    )
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    print(f"{'rows':>9} {'legacy':>10} {'list':>10} {'packed':>10} {'speedup':>8}")
+
+    for n in [1_000, 10_000, 100_000, 1_000_000]:
+        df = make_frame(n)
+        repeat = 3 if n < 1_000_000 else 1
+
+        expected = np.array(legacy_add_color(df, add_opacity=True).color.tolist())
+        packed = utils.add_color(df, add_opacity=True, packed=True)
+        assert (packed[["r", "g", "b", "a"]].to_numpy() == expected).all()
+
+        legacy = best_of(lambda: legacy_add_color(df, add_opacity=True), repeat)
+        as_list = best_of(lambda: utils.add_color(df, add_opacity=True), repeat)
+        as_packed = best_of(
+            lambda: utils.add_color(df, add_opacity=True, packed=True), repeat
+        )
+
+        print(
+            f"{n:>9} {legacy:>9.4f}s {as_list:>9.4f}s {as_packed:>9.4f}s"
+            f" {legacy / as_packed:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Run time of the nightly parcel analytics by number of workers
+
+    python benchmarks/bench_analytics.py [--rows 1000000] [--data-dir DIR]
+        [--workers 1 2 4]
+
+Builds the replica of the synthetic tables (see synthetic.py) once and runs
+``analytics.build`` with each number of workers, so the scaling with the
+number of cores shows in the speedup column.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import bench_suite
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None)
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1]
+    )
+    args = parser.parse_args()
+
+    # spawned workers import analytics from the path
+    paths = [os.path.abspath(bench_suite.SRC), os.environ.get("PYTHONPATH", "")]
+    os.environ["PYTHONPATH"] = os.pathsep.join(p for p in paths if p)
+    sys.path.insert(0, os.path.abspath(bench_suite.SRC))
+
+    import analytics
+    from connect import get_db2_engine
+    from replica import Replica
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_dir = args.data_dir or os.path.join(work_dir, "data")
+        bench_suite.prepare(data_dir, args.rows, args.seed)
+
+        replica = Replica(os.path.join(work_dir, "replica"), get_db2_engine())
+        replica.refresh_all()
+
+        print(f"{'workers':>7} {'seconds':>9} {'speedup':>8} {'parcels':>8}")
+        first = None
+        for workers in sorted(set(args.workers)):
+            start = time.perf_counter()
+            metrics = analytics.build(
+                os.path.join(work_dir, "parcels.parquet"), replica, workers=workers
+            )
+            seconds = time.perf_counter() - start
+            first = first or seconds
+
+            print(
+                f"{workers:>7} {seconds:>9.2f} {first / seconds:>8.2f}"
+                f" {len(metrics):>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
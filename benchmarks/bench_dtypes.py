@@ -0,0 +1,80 @@
+"""Memory of the loader outputs with and without the dtype policy
+
+    python benchmarks/bench_dtypes.py [--rows 100000] [--data-dir DIR]
+
+Runs the loaders of the user view on synthetic data (see synthetic.py) twice,
+once as they are and once with ``loaders.compact`` replaced by the identity,
+and prints the deep memory usage of each result.
+"""
+import argparse
+import os
+import tempfile
+
+import bench_suite
+from bench_suite import MAX_DATE, MIN_DATE
+
+
+def loader_calls(loaders, user):
+    meas = loaders.get_user_measurements.__wrapped__(user, MIN_DATE, MAX_DATE)
+    lat, lon = meas.latitude.mean(), meas.longitude.mean()
+
+    return {
+        "get_user_measurements": lambda: meas,
+        "get_weather_data": lambda: loaders.get_weather_data.__wrapped__(
+            user, MIN_DATE, MAX_DATE
+        ),
+        "get_cohort_stats": lambda: loaders.get_cohort_stats.__wrapped__(
+            None, MIN_DATE, MAX_DATE
+        ),
+        "get_locations": lambda: loaders.get_locations(lat, lon),
+        "get_linked_mnlso": lambda: loaders.get_linked_mnlso(meas, MIN_DATE, MAX_DATE),
+    }
+
+
+def sizes(loaders, user):
+    return {
+        name: int(call().memory_usage(deep=True).sum())
+        for name, call in loader_calls(loaders, user).items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None)
+    args = parser.parse_args()
+
+    os.chdir(bench_suite.REPO)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_dir = args.data_dir or os.path.join(work_dir, "data")
+        parcels_path = bench_suite.prepare(data_dir, args.rows, args.seed)
+
+        # points the loaders at the synthetic data
+        bench_suite.make_cases(work_dir, parcels_path, repeat=1)
+        import loaders
+
+        # the loaders only refresh a replica that has been copied before
+        loaders.get_replica().refresh_all()
+
+        user = int(loaders.get_user_ids(MIN_DATE, MAX_DATE, min_meas=0).counts.idxmax())
+
+        compact = loaders.compact
+        after = sizes(loaders, user)
+        loaders.compact = lambda frame: frame
+        try:
+            before = sizes(loaders, user)
+        finally:
+            loaders.compact = compact
+
+    print(f"{'loader':<24} {'before KiB':>11} {'after KiB':>11} {'ratio':>7}")
+    for name in after:
+        print(
+            f"{name:<24} {before[name] / 2**10:>11.1f} {after[name] / 2**10:>11.1f}"
+            f" {after[name] / max(before[name], 1):>7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Check the cold import time of the modules the app imports at startup
+
+    python benchmarks/bench_imports.py [--budget 1.5]
+
+Every run imports the app modules in a fresh interpreter. Exits with a
+non-zero status when the best run is over the budget (in seconds) or when a
+module that should only be imported on first use is loaded at startup.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+
+# the modules src/main.py imports, without running the app
+APP_MODULES = ["containers", "context", "warmup"]
+
+# only needed once something is drawn or fetched
+DEFERRED_MODULES = [
+    "matplotlib",
+    "pydeck",
+    "scipy",
+    "ibmpairs",
+    "cloudant",
+]
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import streamlit
+streamlit_done = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+end = time.perf_counter()
+print(json.dumps({{
+    "streamlit": streamlit_done - start,
+    "app": end - streamlit_done,
+    "loaded": [m for m in {deferred!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure():
+    script = SCRIPT.format(modules=APP_MODULES, deferred=DEFERRED_MODULES)
+    path = [os.path.abspath(SRC), os.environ.get("PYTHONPATH", "")]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget", type=float, default=1.5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.repeat)]
+    best = min(runs, key=lambda r: r["app"])
+
+    print(f"streamlit {best['streamlit']:.3f}s, app modules {best['app']:.3f}s")
+
+    failed = False
+    if best["app"] > args.budget:
+        print(f"over the budget of {args.budget:.3f}s")
+        failed = True
+
+    if best["loaded"]:
+        print(f"imported at startup: {', '.join(best['loaded'])}")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Repeated-query latency of inlined versus bound SQL on a SQLite stand-in
+
+    python benchmarks/bench_queries.py
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from connect import get_pool_options  # noqa: E402
+from replica import to_day  # noqa: E402
+
+N_USERS = 500
+N_QUERIES = 1_000
+
+
+def make_database(path, n_rows=200_000, seed=0):
+    rng = np.random.default_rng(seed)
+    start = datetime(year=2022, month=1, day=1)
+
+    frame = pd.DataFrame(
+        {
+            "userid": rng.integers(0, N_USERS, n_rows),
+            "layer_id": rng.choice([49250, 49308, 49309], n_rows),
+            "layer_name": "Precip past 1 h",
+            "meas_time": [
+                (start + timedelta(hours=int(h))).strftime("%Y-%m-%d %H:%M:%S")
+                for h in rng.integers(0, 24 * 300, n_rows)
+            ],
+            "meas_value": rng.random(n_rows),
+        }
+    )
+
+    with sqlite3.connect(path) as connection:
+        frame.to_sql("WEATHERDATA", connection, index=False)
+        connection.execute(
+            "CREATE INDEX weather_user ON WEATHERDATA (userid, meas_time)"
+        )
+
+
+def inlined(engine, user_id, min_date, max_date):
+    return pd.read_sql(
+        f"""
+            SELECT
+                layer_id,
+                layer_name,
+                meas_time as timestamp,
+                meas_value as value
+            FROM WEATHERDATA
+            WHERE
+                userid = {user_id} AND
+                meas_time >= '{min_date:%Y-%m-%d}' AND
+                meas_time <= '{max_date:%Y-%m-%d}'
+            """,
+        con=engine,
+    )
+
+
+QUERY = text(
+    """
+    SELECT
+        layer_id,
+        layer_name,
+        meas_time as timestamp,
+        meas_value as value
+    FROM WEATHERDATA
+    WHERE
+        userid = :user_id AND
+        meas_time >= :min_date AND
+        meas_time <= :max_date
+    """
+)
+
+
+def bound(engine, user_id, min_date, max_date):
+    return pd.read_sql(
+        QUERY,
+        con=engine,
+        params={
+            "user_id": user_id,
+            "min_date": to_day(min_date),
+            "max_date": to_day(max_date),
+        },
+    )
+
+
+def run(func, engine, seed=1):
+    rng = np.random.default_rng(seed)
+    min_date = datetime(year=2022, month=3, day=1)
+    max_date = datetime(year=2022, month=6, day=1)
+    latencies = []
+
+    for user_id in rng.integers(0, N_USERS, N_QUERIES):
+        start = time.perf_counter()
+        func(engine, int(user_id), min_date, max_date)
+        latencies.append(time.perf_counter() - start)
+
+    return np.array(latencies) * 1000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stand-in.sqlite")
+        make_database(path)
+        url = f"sqlite:///{path}"
+
+        cases = [
+            ("inlined, default engine", inlined, create_engine(url)),
+            ("bound, default engine", bound, create_engine(url)),
+            ("bound, tuned pool", bound, create_engine(url, **get_pool_options(url))),
+        ]
+
+        print(f"{'case':<26} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8}")
+        for name, func, engine in cases:
+            # warm up the pool and caches before measuring
+            run(func, engine, seed=0)
+            latencies = run(func, engine)
+
+            print(
+                f"{name:<26} {latencies.mean():>8.3f}"
+                f" {np.percentile(latencies, 50):>8.3f}"
+                f" {np.percentile(latencies, 95):>8.3f}"
+            )
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
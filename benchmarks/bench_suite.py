@@ -0,0 +1,356 @@
+"""Time and peak memory of every loader and hot utility on synthetic data
+
+    python benchmarks/bench_suite.py [--rows 100000] [--data-dir DIR]
+        [--output results.json] [--baseline baseline.json] [--tolerance 0.25]
+
+Generates the synthetic tables (see synthetic.py) unless ``--data-dir``
+already holds them at the same scale, points the loaders at them and runs
+every case. The cached loaders are called through ``__wrapped__``, so the
+numbers are for a cache miss. With ``--baseline`` the run exits non-zero
+when a case got slower or uses more memory than the tolerance allows.
+
+Peak memory is measured with tracemalloc in a separate run of each case. It
+covers Python and numpy allocations, not the Arrow memory pool.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import synthetic
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+REPO = os.path.join(os.path.dirname(__file__), "..")
+
+MIN_DATE = datetime(year=2017, month=1, day=1)
+MAX_DATE = datetime(year=2022, month=12, day=1)
+
+# differences below this are noise, whatever the tolerance
+MIN_SECONDS = 0.002
+MIN_BYTES = 64 * 2**10
+
+
+def prepare(data_dir, rows, seed):
+    meta_path = os.path.join(data_dir, "meta.json")
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        meta = None
+
+    if meta != {"rows": rows, "seed": seed}:
+        start = time.perf_counter()
+        synthetic.generate(data_dir, rows, seed=seed)
+        print(f"generated {rows} rows in {time.perf_counter() - start:.1f}s")
+
+    # the loaders read their configuration when they are imported
+    os.environ["DB2_URL"] = f"sqlite:///{os.path.join(data_dir, 'db.sqlite')}"
+    os.environ["CACHE_DISK_PATH"] = ""
+    os.environ["WARMUP_PARCELS"] = "0"
+
+    return os.path.join(data_dir, "parcels.jsonl")
+
+
+def result_size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+def measure(setup, func, repeat):
+    """Best wall time of ``repeat`` calls, and the peak memory of one call
+
+    ``setup`` runs untimed before every call.
+    """
+    setup = setup or (lambda: None)
+
+    seconds = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        value = func()
+        seconds.append(time.perf_counter() - start)
+
+    setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": min(seconds), "peak_bytes": peak, "rows": result_size(value)}
+
+
+def make_cases(work_dir, parcels_path, repeat):
+    """(name, setup, func, repeat) of every case, see ``measure``"""
+    sys.path.insert(0, os.path.abspath(SRC))
+
+    import analytics
+    import loaders
+    import utils
+    import weather
+    from distribution import ValueDistribution
+    from parcels import ParcelStore
+    from replica import Replica
+    from stations import SeriesIndex, StationIndex
+
+    client = synthetic.JsonClient(parcels_path)
+    database = client["parcels"]
+
+    engine = loaders.get_db2_connection()
+    replica = Replica(os.path.join(work_dir, "replica"), engine)
+    parcel_store = ParcelStore(os.path.join(work_dir, "parcels.sqlite"))
+    station_index = StationIndex(engine, normalize=loaders.normalize_values)
+    series_index = SeriesIndex(engine)
+
+    # the loaders share these with the benchmarks below
+    loaders.get_replica = lambda: replica
+    loaders.get_cloudant_connection = lambda: client
+    loaders.get_parcel_store = lambda: parcel_store
+    loaders.get_station_index = lambda: station_index
+    loaders.get_series_index = lambda: series_index
+
+    state = {"distribution": ValueDistribution()}
+    loaders.get_value_distribution = lambda: state["distribution"]
+
+    def fresh_replica():
+        replica.root = os.path.join(work_dir, f"replica-{time.monotonic_ns()}")
+
+    def fresh_distribution():
+        state["distribution"] = ValueDistribution()
+
+    def fresh_parcel_store():
+        with parcel_store._connection:
+            parcel_store._connection.execute("DELETE FROM parcels")
+            parcel_store._connection.execute("DELETE FROM checkpoint")
+
+    def busiest_user():
+        if "user" not in state:
+            counts = loaders.get_user_ids(MIN_DATE, MAX_DATE, min_meas=0)
+            state["user"] = int(counts.counts.idxmax())
+            meas = loaders.get_user_measurements.__wrapped__(
+                state["user"], MIN_DATE, MAX_DATE
+            )
+            state["position"] = (meas.latitude.mean(), meas.longitude.mean())
+            state["meetpunt"] = meas.meetpunt_code_ihw.iloc[0]
+            state["meas"] = meas
+            state["frame"] = replica.read(
+                "measurements", columns=["timestamp", "value"]
+            )
+
+    def with_user(func):
+        def run():
+            return func(state["user"])
+
+        return busiest_user, run
+
+    def wrapped(loader):
+        return loader.__wrapped__
+
+    cases = [
+        ("replica.refresh_all (initial)", fresh_replica, replica.refresh_all, repeat),
+        ("replica.refresh_all (up to date)", None, replica.refresh_all, repeat),
+        (
+            "get_usage_dates",
+            None,
+            lambda: loaders.get_usage_dates(lookback_days=14, min_meas=5),
+            repeat,
+        ),
+        (
+            "get_user_ids",
+            None,
+            lambda: loaders.get_user_ids(MIN_DATE, MAX_DATE, min_meas=3),
+            repeat,
+        ),
+        (
+            "get_user_measurements",
+            *with_user(
+                lambda user: wrapped(loaders.get_user_measurements)(
+                    user, MIN_DATE, MAX_DATE
+                )
+            ),
+            repeat,
+        ),
+        (
+            "get_weather_data",
+            *with_user(
+                lambda user: wrapped(loaders.get_weather_data)(user, MIN_DATE, MAX_DATE)
+            ),
+            repeat,
+        ),
+        (
+            "get_weather_data (2 layers, downsampled)",
+            *with_user(
+                lambda user: wrapped(loaders.get_weather_data)(
+                    user,
+                    MIN_DATE,
+                    MAX_DATE,
+                    layers=("Precip past 1 h", "Snow past 24 h"),
+                    max_points=1000,
+                )
+            ),
+            repeat,
+        ),
+        (
+            "get_nitrate_distribution (initial)",
+            fresh_distribution,
+            loaders.get_nitrate_distribution,
+            repeat,
+        ),
+        (
+            "get_nitrate_distribution (up to date)",
+            None,
+            loaders.get_nitrate_distribution,
+            repeat,
+        ),
+        ("SeriesIndex.refresh", None, series_index.refresh, repeat),
+        (
+            "get_mnlso_measurements",
+            busiest_user,
+            lambda: loaders.get_mnlso_measurements(state["meetpunt"]),
+            repeat,
+        ),
+        (
+            "get_linked_mnlso",
+            busiest_user,
+            lambda: loaders.get_linked_mnlso(state["meas"], MIN_DATE, MAX_DATE),
+            repeat,
+        ),
+        ("get_weather_layers", None, wrapped(loaders.get_weather_layers), repeat),
+        ("load_measuremaps", None, wrapped(loaders.load_measuremaps), repeat),
+        (
+            "ParcelStore.sync (initial)",
+            fresh_parcel_store,
+            lambda: parcel_store.sync(database),
+            repeat,
+        ),
+        ("get_parcel_data", *with_user(loaders.get_parcel_data), repeat),
+        ("StationIndex.refresh", None, station_index.refresh, repeat),
+        (
+            "get_locations",
+            busiest_user,
+            lambda: loaders.get_locations(*state["position"]),
+            repeat,
+        ),
+        (
+            "utils.add_color (all measurements)",
+            busiest_user,
+            lambda: utils.add_color(state["frame"], add_opacity=True, packed=True),
+            repeat,
+        ),
+        (
+            "utils.get_opacity (all measurements)",
+            busiest_user,
+            lambda: utils.get_opacity(state["frame"]),
+            repeat,
+        ),
+        (
+            "analytics.parcel_metrics (all parcels)",
+            None,
+            lambda: analytics.parcel_metrics(
+                replica.read("measurements", columns=analytics.COLUMNS)
+            ),
+            repeat,
+        ),
+        (
+            "weather.get_intervals (x1000)",
+            None,
+            lambda: [weather.get_intervals(MIN_DATE, MAX_DATE) for _ in range(1000)],
+            repeat,
+        ),
+    ]
+
+    return cases
+
+
+def compare(results, baseline, tolerance):
+    """Names of the cases that regressed against the baseline"""
+    regressions = []
+
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+
+        slower = result["seconds"] > max(
+            before["seconds"] * (1 + tolerance), before["seconds"] + MIN_SECONDS
+        )
+        bigger = result["peak_bytes"] > max(
+            before["peak_bytes"] * (1 + tolerance), before["peak_bytes"] + MIN_BYTES
+        )
+
+        if slower or bigger:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    # load_measuremaps reads measuremap.csv from the working directory
+    os.chdir(REPO)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_dir = args.data_dir or os.path.join(work_dir, "data")
+        parcels_path = prepare(data_dir, args.rows, args.seed)
+
+        results = {}
+        print(f"{'case':<42} {'seconds':>9} {'peak MiB':>9} {'rows':>9}")
+
+        cases = make_cases(work_dir, parcels_path, args.repeat)
+        for name, setup, func, repeat in cases:
+            result = measure(setup, func, repeat)
+            results[name] = result
+
+            rows = "" if result["rows"] is None else result["rows"]
+            print(
+                f"{name:<42} {result['seconds']:>9.4f}"
+                f" {result['peak_bytes'] / 2**20:>9.2f} {rows:>9}"
+            )
+
+    report = {
+        "rows": args.rows,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.tolerance)
+        for name in regressions:
+            before = baseline["results"][name]
+            after = results[name]
+            print(
+                f"regression in {name}: {before['seconds']:.4f}s -> "
+                f"{after['seconds']:.4f}s, {before['peak_bytes'] / 2**20:.2f} -> "
+                f"{after['peak_bytes'] / 2**20:.2f} MiB"
+            )
+
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
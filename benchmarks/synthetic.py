@@ -0,0 +1,323 @@
+"""Synthetic stand-ins for the DB2 tables, the Cloudant parcels database and EIS
+
+    python benchmarks/synthetic.py --rows 100000 --out synthetic
+
+Writes ``db.sqlite`` with the NITRATEAPP, NITRATE_ID_MAPPING,
+NITRATEAPP_NL_WITH_LOC_ID, MNLSO, LOCATIONS and WEATHERDATA tables and
+``parcels.jsonl`` with one parcel document per line. ``--rows`` is the number
+of nitrate measurements; parcels, stations and weather scale with it. Point
+the app at the result with DB2_URL=sqlite:///synthetic/db.sqlite.
+"""
+import argparse
+import json
+import math
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+START = np.datetime64("2017-01-01T00:00:00")
+END = np.datetime64("2022-12-01T00:00:00")
+
+# rough bounding box of the Netherlands
+LAT_RANGE = (51.0, 53.5)
+LON_RANGE = (3.5, 7.0)
+
+CATEGORIES = ["grondwater", "oppervlaktewater", "groundwater", "surface water", "other"]
+
+WEATHER_LAYERS = {
+    49250: "Precip past 1 h",
+    49251: "Precip past 6 h",
+    49252: "Precip past 24 h",
+    49249: "Snow past 24 h",
+    49308: "Minimum temperature past 24 h",
+    49309: "Maximum temperature past 24 h",
+}
+
+CHUNKSIZE = 500_000
+
+
+def to_sql_time(times):
+    """'YYYY-MM-DD HH:MM:SS' strings, which sort and compare like the times"""
+    return np.char.replace(np.datetime_as_string(times, unit="s"), "T", " ")
+
+
+def random_times(rng, n):
+    seconds = rng.integers(0, (END - START) // np.timedelta64(1, "s"), n)
+    return START + seconds.astype("timedelta64[s]")
+
+
+def sizes(n_rows):
+    """Number of parcels, stations and weather rows for n measurements"""
+    return {
+        "parcels": max(10, n_rows // 200),
+        "stations": min(5_000, max(20, n_rows // 1_000)),
+        "mnlso": max(100, n_rows // 10),
+        "weather": n_rows,
+    }
+
+
+def make_parcel_centres(rng, n_parcels):
+    return np.column_stack(
+        [rng.uniform(*LAT_RANGE, n_parcels), rng.uniform(*LON_RANGE, n_parcels)]
+    )
+
+
+def write_chunks(connection, table, n, make_chunk):
+    for start in range(0, n, CHUNKSIZE):
+        chunk = make_chunk(start, min(n, start + CHUNKSIZE))
+        chunk.to_sql(table, connection, index=False, if_exists="append")
+
+
+def make_database(path, n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    n = sizes(n_rows)
+
+    centres = make_parcel_centres(np.random.default_rng(seed), n["parcels"])
+    stations = pd.DataFrame(
+        {
+            "meetpunt_code_ihw": [f"NL-{i:05d}" for i in range(n["stations"])],
+            "lat": rng.uniform(*LAT_RANGE, n["stations"]),
+            "lon": rng.uniform(*LON_RANGE, n["stations"]),
+        }
+    )
+
+    def measurements(start, end):
+        size = end - start
+        # a few parcels measure a lot, most only now and then
+        parcel = (rng.random(size) ** 3 * n["parcels"]).astype(np.int64)
+        times = np.sort(random_times(rng, size))
+
+        return pd.DataFrame(
+            {
+                "id": np.arange(start, end, dtype=np.int64),
+                "parcel_id": parcel,
+                "timestamp": to_sql_time(times),
+                "value": rng.gamma(2.0, 15.0, size).round(2) + 0.1,
+                "latitude": centres[parcel, 0] + rng.normal(0, 0.002, size),
+                "longitude": centres[parcel, 1] + rng.normal(0, 0.002, size),
+                "category": rng.choice(CATEGORIES, size),
+                "confidence": rng.random(size).round(3),
+                "meetpunt_code_ihw": stations.meetpunt_code_ihw.to_numpy()[
+                    rng.integers(0, n["stations"], size)
+                ],
+            }
+        )
+
+    def mnlso(start, end):
+        size = end - start
+        return pd.DataFrame(
+            {
+                "meetpunt_code": stations.meetpunt_code_ihw.to_numpy()[
+                    rng.integers(0, n["stations"], size)
+                ],
+                "datum": to_sql_time(random_times(rng, size)),
+                "waarde": rng.gamma(2.0, 12.0, size).round(2),
+                "parameter_code": rng.choice(["NO3", "NO3", "NO3", "NH4"], size),
+                "groeiseizoen": rng.integers(2017, 2023, size),
+            }
+        )
+
+    layer_ids = np.array(list(WEATHER_LAYERS))
+    layer_names = np.array(list(WEATHER_LAYERS.values()))
+
+    def weather(start, end):
+        size = end - start
+        layer = rng.integers(0, len(layer_ids), size)
+        hours = rng.integers(0, (END - START) // np.timedelta64(1, "h"), size)
+
+        return pd.DataFrame(
+            {
+                "userid": rng.integers(0, n["parcels"], size),
+                "layer_id": layer_ids[layer],
+                "layer_name": layer_names[layer],
+                "meas_time": to_sql_time(START + hours.astype("timedelta64[h]")),
+                "meas_value": rng.gamma(1.0, 2.0, size).round(3),
+            }
+        )
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    with sqlite3.connect(path) as connection:
+        stations.to_sql("LOCATIONS", connection, index=False)
+
+        for start in range(0, n_rows, CHUNKSIZE):
+            chunk = measurements(start, min(n_rows, start + CHUNKSIZE))
+            chunk.to_sql(
+                "NITRATEAPP_NL_WITH_LOC_ID", connection, index=False, if_exists="append"
+            )
+            chunk[["id", "timestamp", "value"]].to_sql(
+                "NITRATEAPP", connection, index=False, if_exists="append"
+            )
+            chunk[["id", "parcel_id"]].rename(columns={"id": "nitrate_id"}).to_sql(
+                "NITRATE_ID_MAPPING", connection, index=False, if_exists="append"
+            )
+
+        write_chunks(connection, "MNLSO", n["mnlso"], mnlso)
+        write_chunks(connection, "WEATHERDATA", n["weather"], weather)
+
+        for statement in [
+            'CREATE INDEX nitrate_time ON NITRATEAPP ("timestamp")',
+            'CREATE INDEX nl_time ON NITRATEAPP_NL_WITH_LOC_ID ("timestamp")',
+            "CREATE INDEX mapping_id ON NITRATE_ID_MAPPING (nitrate_id)",
+            "CREATE INDEX mnlso_code ON MNLSO (meetpunt_code, parameter_code, datum)",
+            "CREATE INDEX weather_user ON WEATHERDATA (userid, meas_time)",
+        ]:
+            connection.execute(statement)
+
+
+def parcel_geometry(rng, lat, lon, n_vertices):
+    angles = np.sort(rng.uniform(0, 2 * math.pi, n_vertices))
+    radius = rng.uniform(0.001, 0.004) * rng.uniform(0.7, 1.0, n_vertices)
+    ring = np.column_stack(
+        [lon + radius * np.cos(angles), lat + radius * np.sin(angles)]
+    )
+    ring = np.vstack([ring, ring[:1]]).round(7).tolist()
+
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def make_parcels(path, n_rows, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    centres = make_parcel_centres(np.random.default_rng(seed), sizes(n_rows)["parcels"])
+
+    with open(path, "w") as f:
+        for objectid, (lat, lon) in enumerate(centres):
+            doc = {
+                "_id": f"parcel-{objectid}",
+                "type": "Feature",
+                "properties": {
+                    "OBJECTID": objectid,
+                    "GEWASCODE": int(rng.integers(1, 300)),
+                },
+                "geometry": parcel_geometry(rng, lat, lon, int(rng.integers(8, 200))),
+            }
+            f.write(json.dumps(doc, separators=(",", ":")) + "\n")
+
+
+class Feed(list):
+    """Result of JsonDatabase.changes, iterable like the cloudant feed"""
+
+    last_seq = "0"
+
+
+class JsonDatabase:
+    """Read-only stand-in for the Cloudant ``parcels`` database
+
+    Supports the calls the app makes: ``changes`` with integer sequences and
+    ``get_query_result`` with an ``$eq`` selector on one field.
+    """
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.docs = [json.loads(line) for line in f]
+
+    def changes(self, since="0", include_docs=False, limit=None):
+        start = int(since)
+        end = len(self.docs) if limit is None else min(len(self.docs), start + limit)
+
+        feed = Feed(
+            {
+                "id": doc["_id"],
+                "seq": str(seq + 1),
+                **({"doc": doc} if include_docs else {}),
+            }
+            for seq, doc in enumerate(self.docs[start:end], start)
+        )
+        feed.last_seq = str(end)
+        return feed
+
+    def get_query_result(self, selector):
+        (field, condition), *_ = selector.items()
+        path = field.split(".")
+
+        def value(doc):
+            for key in path:
+                doc = doc.get(key, {})
+            return doc
+
+        return [doc for doc in self.docs if value(doc) == condition["$eq"]]
+
+
+class JsonClient:
+    """Stand-in for the Cloudant client, ``client["parcels"]``"""
+
+    def __init__(self, parcels_path):
+        self.databases = {"parcels": JsonDatabase(parcels_path)}
+
+    def __getitem__(self, name):
+        return self.databases[name]
+
+
+class MockEis:
+    """Stand-in for ``weather.submit_query``, pass it as ``submit``
+
+    Answers a point query with one value per point, layer and requested time,
+    every day of a ``start``/``end`` interval, in the shape of the EIS point
+    data. The queries are kept in ``queries``.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def __call__(self, query_json):
+        with self._lock:
+            self.queries.append(query_json)
+
+        coordinates = [float(c) for c in query_json["spatial"]["coordinates"]]
+        points = list(zip(coordinates[::2], coordinates[1::2]))
+
+        times = []
+        for interval in query_json["temporal"]["intervals"]:
+            if "snapshot" in interval:
+                times.append(pd.Timestamp(interval["snapshot"]))
+            else:
+                times.extend(pd.date_range(interval["start"], interval["end"]))
+
+        rows = [
+            (layer["id"], time, lat, lon)
+            for layer in query_json["layers"]
+            for time in times
+            for lat, lon in points
+        ]
+        data = pd.DataFrame(rows, columns=["layerId", "time", "latitude", "longitude"])
+
+        return data.assign(
+            timestamp=data.time.map(lambda t: int(t.timestamp() * 1000)),
+            value=(data.latitude + data.longitude + data.time.dt.dayofyear) % 30,
+        ).drop(columns="time")
+
+
+def generate(out, n_rows, seed=0):
+    """Write db.sqlite and parcels.jsonl to ``out``, returns their paths"""
+    os.makedirs(out, exist_ok=True)
+
+    db_path = os.path.join(out, "db.sqlite")
+    parcels_path = os.path.join(out, "parcels.jsonl")
+
+    make_database(db_path, n_rows, seed=seed)
+    make_parcels(parcels_path, n_rows, seed=seed)
+
+    with open(os.path.join(out, "meta.json"), "w") as f:
+        json.dump({"rows": n_rows, "seed": seed}, f)
+
+    return db_path, parcels_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="synthetic")
+    args = parser.parse_args()
+
+    for path in generate(args.out, args.rows, seed=args.seed):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
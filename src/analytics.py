@@ -0,0 +1,209 @@
+"""Compute the nitrate metrics of every parcel into one Parquet file
+
+    python src/analytics.py [--path analytics/parcels.parquet] [--workers N]
+        [--budget 3600]
+
+For every parcel with measurements in the replica: the mean and max over
+the trailing 30 and 365 days up to its latest measurement, the Theil-Sen
+trend in mg/L per year and how often the norm was exceeded. The parcels are
+split into batches of about the same number of rows, which a process pool
+reads from the replica and computes independently, so the run time goes
+down with the number of cores. The metrics section looks a parcel up in the
+result. Run it nightly after the replica refresh (``python src/replica.py``).
+It reads the replica up to its watermark and does not write to it, and exits
+non-zero when the run took longer than the budget.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cohort import MAX_TREND_POINTS, NITRATE_NORM, trends
+from replica import Replica, replace_parquet
+
+COLUMNS = ["parcel_id", "timestamp", "value"]
+
+# the trailing windows, days up to the latest measurement of a parcel. One
+# value per parcel, not a rolling series
+WINDOWS = (30, 365)
+
+# batches per worker, so a slow batch does not leave the other workers idle
+BATCHES_PER_WORKER = 4
+
+SCHEMA = pa.schema(
+    [
+        ("parcel_id", pa.int64()),
+        ("n_meas", pa.int32()),
+        ("first_time", pa.timestamp("us")),
+        ("last_time", pa.timestamp("us")),
+        ("latest", pa.float32()),
+        ("trailing_mean_30d", pa.float32()),
+        ("trailing_max_30d", pa.float32()),
+        ("trailing_mean_365d", pa.float32()),
+        ("trailing_max_365d", pa.float32()),
+        ("trend", pa.float32()),
+        ("exceedance", pa.float32()),
+        ("trailing_exceedance_365d", pa.float32()),
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parcel_metrics(meas, norm=NITRATE_NORM, max_points=MAX_TREND_POINTS):
+    """Metrics of every parcel in the measurements, one row per parcel"""
+    meas = meas.dropna(subset=["value"])
+    if meas.empty:
+        return pd.DataFrame(columns=SCHEMA.names)
+
+    meas = meas.sort_values(["parcel_id", "timestamp"], ignore_index=True)
+    parcel_id = meas.parcel_id
+    grouped = meas.groupby("parcel_id", sort=True)
+
+    age = grouped.timestamp.transform("max") - meas.timestamp
+    over = (meas.value > norm).astype(np.float64)
+
+    metrics = pd.DataFrame(
+        {
+            "n_meas": grouped.size(),
+            "first_time": grouped.timestamp.first(),
+            "last_time": grouped.timestamp.last(),
+            "latest": grouped.value.last(),
+            "exceedance": over.groupby(parcel_id).mean(),
+        }
+    )
+
+    for days in WINDOWS:
+        recent = age <= pd.Timedelta(days=days)
+        values = meas.value.where(recent).groupby(parcel_id)
+
+        metrics[f"trailing_mean_{days}d"] = values.mean()
+        metrics[f"trailing_max_{days}d"] = values.max()
+
+    metrics["trailing_exceedance_365d"] = (
+        over.where(age <= pd.Timedelta(days=365)).groupby(parcel_id).mean()
+    )
+    metrics["trend"] = trends(meas, max_points)
+
+    return metrics.rename_axis("parcel_id").reset_index()[SCHEMA.names]
+
+
+def compute_batch(root, parcel_ids, snapshot):
+    """Metrics of a batch of parcels, runs in a worker process"""
+    replica = Replica(root, None)
+    meas = replica.read(
+        "measurements", columns=COLUMNS, parcel_ids=parcel_ids, max_date=snapshot
+    )
+
+    return parcel_metrics(meas)
+
+
+def plan(replica, n_batches, snapshot):
+    """Parcel ids in ``n_batches`` batches of about the same number of rows"""
+    counts = (
+        replica.read("measurements", columns=["parcel_id"], max_date=snapshot)
+        .parcel_id.value_counts()
+        .sort_index()
+    )
+    if counts.empty:
+        return []
+
+    batch = (counts.cumsum().to_numpy() - 1) * n_batches // counts.sum()
+    splits = np.flatnonzero(np.diff(batch)) + 1
+
+    return [ids.tolist() for ids in np.split(counts.index.to_numpy(), splits)]
+
+
+def build(path, replica, workers=None):
+    """Compute and store the metrics of all parcels, returns them"""
+    workers = workers or os.cpu_count() or 1
+
+    # a refresh only adds rows after the watermark and moves it after the
+    # rows, so everything up to it is a consistent snapshot of the replica
+    snapshot = replica.watermark("measurements")
+    batches = plan(replica, workers * BATCHES_PER_WORKER, snapshot)
+
+    if workers == 1:
+        frames = [compute_batch(replica.root, batch, snapshot) for batch in batches]
+    else:
+        # pyarrow's threads do not survive a fork
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            frames = list(
+                pool.map(
+                    compute_batch, repeat(replica.root), batches, repeat(snapshot)
+                )
+            )
+
+    frames = [f for f in frames if not f.empty]
+    metrics = (
+        pd.concat(frames, ignore_index=True)
+        if frames
+        else pd.DataFrame(columns=SCHEMA.names)
+    )
+    replace_parquet(path, metrics, SCHEMA)
+
+    return metrics
+
+
+class ParcelMetrics:
+    """The stored metrics, read once per file change and indexed by parcel"""
+
+    def __init__(self, path):
+        self.path = path
+        self._cached = None
+        self._lock = threading.Lock()
+
+    def get(self, parcel_id):
+        """Metrics of one parcel as a dict, None when it has none"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            if self._cached is None or self._cached[0] != mtime:
+                metrics = pq.read_table(self.path).to_pandas().set_index("parcel_id")
+                self._cached = (mtime, metrics)
+
+        metrics = self._cached[1]
+        if int(parcel_id) not in metrics.index:
+            return None
+
+        return metrics.loc[int(parcel_id)].to_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--path", default=os.environ.get("ANALYTICS_PATH", "analytics/parcels.parquet")
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--budget", type=float, default=3600, help="seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.perf_counter()
+
+    replica = Replica(os.environ.get("NITRATE_REPLICA_DIR", "replica"), None)
+    metrics = build(args.path, replica, workers=args.workers)
+    seconds = time.perf_counter() - start
+
+    logger.info("%d parcels in %.1fs", len(metrics), seconds)
+    if seconds > args.budget:
+        logger.error("took %.1fs, the budget is %.0fs", seconds, args.budget)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sqlite3
+import stat
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import tracing
+
+MEMORY_MAX_BYTES = int(os.environ.get("CACHE_MEMORY_MAX_BYTES", 512 * 2**20))
+DISK_MAX_BYTES = int(os.environ.get("CACHE_DISK_MAX_BYTES", 2 * 2**30))
+
+# processes on the same host share this file. Values are unpickled from it,
+# so the disk tier is off unless a path is configured, see DiskTier
+DISK_PATH = os.environ.get("CACHE_DISK_PATH", "")
+
+
+def sizeof(value):
+    """Approximate size in bytes of a cached value"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        size = value.memory_usage(deep=True)
+        return int(size.sum() if isinstance(size, pd.Series) else size)
+
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def normalize(value):
+    """Make equal arguments hash equally, e.g. numpy.int64(5) and 5"""
+    if isinstance(value, np.generic):
+        return value.item()
+
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(v) for v in value)
+
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items()))
+
+    return value
+
+
+def make_key(namespace, arguments):
+    """Key of a call, ``arguments`` maps every parameter to its bound value"""
+    arguments = sorted((k, normalize(v)) for k, v in arguments.items())
+    digest = hashlib.sha1(pickle.dumps(arguments, protocol=4)).hexdigest()
+
+    return f"{namespace}:{digest}"
+
+
+class MemoryTier:
+    """LRU of values bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+
+    def get(self, key, now):
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        expires, size, value = item
+        if expires < now:
+            self.pop(key)
+            return None
+
+        self._items.move_to_end(key)
+        return item
+
+    def pop(self, key):
+        _, size, _ = self._items.pop(key)
+        self.bytes -= size
+
+    def set(self, key, value, expires, size):
+        """Store a value, returns the keys evicted to make room"""
+        if key in self._items:
+            self.pop(key)
+
+        self._items[key] = (expires, size, value)
+        self.bytes += size
+
+        evicted = []
+        while self.bytes > self.max_bytes and len(self._items) > 1:
+            oldest = next(iter(self._items))
+            self.pop(oldest)
+            evicted.append(oldest)
+
+        return evicted
+
+    def invalidate(self, namespace):
+        for key in [k for k in self._items if k.startswith(f"{namespace}:")]:
+            self.pop(key)
+
+
+def open_private(path):
+    """Create the file readable and writable by this user only
+
+    An existing file that belongs to another user or that others can write
+    is refused, whoever can write it can run code in the app.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600))
+
+    for checked in (directory, path):
+        info = os.stat(checked)
+        writable = info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+        sticky = info.st_mode & stat.S_ISVTX and checked == directory
+
+        if info.st_uid != os.getuid() or (writable and not sticky):
+            raise PermissionError(
+                f"{checked} has to belong to this user and not be writable by others"
+            )
+
+
+class DiskTier:
+    """Pickled values in a SQLite file, shared by processes on the host"""
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+
+        open_private(path)
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    expires REAL,
+                    accessed REAL,
+                    size INTEGER,
+                    value BLOB
+                )
+                """
+            )
+
+    def get(self, key, now):
+        row = self._connection.execute(
+            "SELECT expires, value FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None or row[0] < now:
+            return None
+
+        with self._connection:
+            self._connection.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+            )
+
+        return row[0], row[1]
+
+    def set(self, key, value, expires, now):
+        """Store a value, returns the number of entries evicted"""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, expires, now, len(blob), blob),
+            )
+            self._connection.execute("DELETE FROM entries WHERE expires < ?", (now,))
+
+            total = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+
+            evicted = 0
+            if total <= self.max_bytes:
+                return evicted
+
+            rows = self._connection.execute(
+                "SELECT key, size FROM entries WHERE key != ? ORDER BY accessed",
+                (key,),
+            ).fetchall()
+            for old_key, size in rows:
+                if total <= self.max_bytes:
+                    break
+
+                self._connection.execute(
+                    "DELETE FROM entries WHERE key = ?", (old_key,)
+                )
+                total -= size
+                evicted += 1
+
+        return evicted
+
+    def invalidate(self, namespace):
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM entries WHERE key LIKE ?", (f"{namespace}:%",)
+            )
+
+
+class Cache:
+    """Two tier cache: an in-process LRU in front of a shared disk tier
+
+    Every namespace (one per cached function) keeps its own hit, miss and
+    eviction counters, see ``stats``.
+    """
+
+    def __init__(
+        self,
+        memory_max_bytes=MEMORY_MAX_BYTES,
+        disk_path=DISK_PATH,
+        disk_max_bytes=DISK_MAX_BYTES,
+    ):
+        self.memory = MemoryTier(memory_max_bytes)
+        self.disk = DiskTier(disk_path, disk_max_bytes) if disk_path else None
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+    def _namespace(self, key):
+        return key.split(":", 1)[0]
+
+    def _count(self, namespace, counter, n=1):
+        with self._lock:
+            self.counters[namespace, counter] += n
+
+    def _set_memory(self, key, value, expires):
+        size = sizeof(value)
+
+        with self._lock:
+            for evicted in self.memory.set(key, value, expires, size):
+                self.counters[self._namespace(evicted), "evictions"] += 1
+
+    def get(self, key, disk=True):
+        """Returns (found, value)"""
+        namespace = self._namespace(key)
+        now = time.time()
+
+        with self._lock:
+            item = self.memory.get(key, now)
+
+        if item is not None:
+            self._count(namespace, "hits")
+            return True, item[2]
+
+        if disk and self.disk is not None:
+            with self._disk_lock:
+                found = self.disk.get(key, now)
+
+            if found is not None:
+                expires, blob = found
+                value = pickle.loads(blob)
+                self._count(namespace, "disk_hits")
+                self._set_memory(key, value, expires)
+                return True, value
+
+        self._count(namespace, "misses")
+        return False, None
+
+    def set(self, key, value, ttl, disk=True):
+        now = time.time()
+        expires = now + ttl
+
+        self._set_memory(key, value, expires)
+
+        if disk and self.disk is not None:
+            with self._disk_lock:
+                evicted = self.disk.set(key, value, expires, now)
+
+            self._count(self._namespace(key), "disk_evictions", evicted)
+
+    def invalidate(self, namespace):
+        with self._lock:
+            self.memory.invalidate(namespace)
+            self.counters[namespace, "invalidations"] += 1
+
+        if self.disk is not None:
+            with self._disk_lock:
+                self.disk.invalidate(namespace)
+
+    def stats(self):
+        """Counters per namespace, e.g. {"get_user_measurements": {"hits": 3}}"""
+        with self._lock:
+            stats = {}
+            for (namespace, counter), count in self.counters.items():
+                stats.setdefault(namespace, {})[counter] = count
+
+            return stats
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_cache():
+    global _default_cache
+
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = Cache()
+
+    return _default_cache
+
+
+def cached(ttl, namespace=None, disk=True):
+    """Cache the results of a function for ``ttl`` seconds
+
+    The arguments are pickled into the key, so they have to be picklable.
+    Values are shared between callers and must not be mutated.
+    """
+
+    def decorator(func):
+        name = namespace or func.__name__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+
+            # f(1), f(x=1) and f() with default x=1 share an entry
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = make_key(name, bound.arguments)
+
+            found, value = cache.get(key, disk=disk)
+            tracing.note(cache="hit" if found else "miss")
+            if found:
+                return value
+
+            value = func(*args, **kwargs)
+            cache.set(key, value, ttl, disk=disk)
+            return value
+
+        wrapper.namespace = name
+        wrapper.invalidate = lambda: get_cache().invalidate(name)
+        return wrapper
+
+    return decorator
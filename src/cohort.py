@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+
+# EU nitrate directive norm for ground and surface water, in mg/L
+NITRATE_NORM = 50.0
+
+SECONDS_PER_YEAR = 365.25 * 24 * 3600
+
+# the trend uses daily medians, longer series are binned down to this many
+# points, which bounds the pairs per parcel to about 500k (~30 MB)
+MAX_TREND_POINTS = 1000
+
+
+def theil_sen(t, v):
+    """Median of the slopes between all pairs of points, nan without any"""
+    i, j = np.triu_indices(len(t), k=1)
+    dt = t[j] - t[i]
+    valid = dt > 0
+
+    if not valid.any():
+        return np.nan
+
+    return float(np.median((v[j] - v[i])[valid] / dt[valid]))
+
+
+def trends(meas, max_points=MAX_TREND_POINTS):
+    """Theil-Sen slope of the daily medians of every parcel, in mg/L per year
+
+    ``meas`` is sorted by parcel and time.
+    """
+    daily = (
+        meas.groupby(["parcel_id", meas.timestamp.dt.floor("D")], sort=True)
+        .value.median()
+        .reset_index()
+    )
+
+    # a long series is binned into max_points runs of consecutive days, the
+    # median value of a run at its mean time
+    grouped = daily.groupby("parcel_id", sort=True)
+    position = grouped.cumcount().to_numpy()
+    size = grouped.parcel_id.transform("size").to_numpy()
+    points = (
+        daily.groupby(["parcel_id", position * max_points // size], sort=True)
+        .agg(timestamp=("timestamp", "mean"), value=("value", "median"))
+        .reset_index(level="parcel_id")
+    )
+
+    parcel_ids = points.parcel_id.to_numpy()
+    t = (points.timestamp - points.timestamp.min()).dt.total_seconds().to_numpy()
+    v = points.value.to_numpy(dtype=np.float64)
+
+    starts = np.flatnonzero(np.r_[True, parcel_ids[1:] != parcel_ids[:-1]])
+    slopes = [
+        theil_sen(ts, vs) * SECONDS_PER_YEAR
+        for ts, vs in zip(np.split(t, starts[1:]), np.split(v, starts[1:]))
+    ]
+
+    return pd.Series(slopes, index=parcel_ids[starts], dtype=np.float64)
+
+
+def parcel_stats(meas, norm=NITRATE_NORM):
+    """Statistics of every parcel in one pass over the measurements
+
+    ``meas`` needs parcel_id, timestamp, value, latitude and longitude. The
+    trend is the Theil-Sen slope in mg/L per year, see ``trends``, the same
+    as in the nightly parcel metrics.
+    """
+    columns = [
+        "parcel_id",
+        "n_meas",
+        "latitude",
+        "longitude",
+        "timestamp",
+        "value",
+        "trend",
+        "exceedance",
+    ]
+    if meas.empty:
+        return pd.DataFrame(columns=columns).astype(
+            {"parcel_id": "int64", "n_meas": "int64", "timestamp": "datetime64[ns]"}
+        )
+
+    meas = meas.sort_values(["parcel_id", "timestamp"])
+    grouped = meas.groupby("parcel_id", sort=True)
+
+    last = grouped.tail(1).set_index("parcel_id")
+    position = grouped[["latitude", "longitude"]].mean()
+
+    stats = pd.DataFrame(
+        {
+            "n_meas": grouped.size(),
+            "latitude": position.latitude,
+            "longitude": position.longitude,
+            "timestamp": last.timestamp,
+            "value": last.value,
+            "trend": trends(meas),
+            "exceedance": (meas.value > norm).groupby(meas.parcel_id).mean(),
+        }
+    )
+
+    return stats.rename_axis("parcel_id").reset_index()[columns]
@@ -1,17 +1,19 @@
 import os
-import requests
-from cloudant.client import Cloudant
 from urllib.parse import quote
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 
-import ibmpairs.authentication as authentication
-import ibmpairs.client as client
+# cloudant, ibmpairs and requests are imported where they are used, they are
+# slow to import and not needed to render the first page
 
 
 AUTH_PROVIDER_BASE = "https://auth-b2b-twc.ibm.com"
 
 
 def get_cloudant_client():
+    from cloudant.client import Cloudant
+
     client = Cloudant(
         os.environ["CLOUDANT_USERNAME"],
         os.environ["CLOUDANT_PASSWORD"],
@@ -23,7 +25,37 @@ def get_cloudant_client():
     return client
 
 
+def get_pool_options(url):
+    """Connection pool settings, shared by all sessions of the app"""
+    options = {}
+
+    # the sizes only apply to a QueuePool, others such as the
+    # SingletonThreadPool of an in-memory sqlite:// url reject them
+    url = make_url(url)
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options = {
+            "pool_size": int(os.environ.get("DB2_POOL_SIZE", 5)),
+            "max_overflow": int(os.environ.get("DB2_MAX_OVERFLOW", 10)),
+            "pool_timeout": int(os.environ.get("DB2_POOL_TIMEOUT", 30)),
+        }
+
+    return {
+        **options,
+        # connections dropped by a firewall or DB2 restart are replaced
+        # before use instead of failing the first query of a session
+        "pool_pre_ping": True,
+        "pool_recycle": int(os.environ.get("DB2_POOL_RECYCLE", 1800)),
+        # compiled statements, keyed on the SQL text with bound parameters
+        "query_cache_size": int(os.environ.get("DB2_QUERY_CACHE_SIZE", 500)),
+    }
+
+
 def get_db2_engine():
+    # any SQLAlchemy url, e.g. a local SQLite stand-in, replaces the DB2 database
+    if "DB2_URL" in os.environ:
+        url = os.environ["DB2_URL"]
+        return create_engine(url, **get_pool_options(url))
+
     uri = "{username}:{password}@{host}:{port}/{database};{extra}".format(
         username=os.environ["DB2_USERNAME"],
         password=quote(os.environ["DB2_PASSWORD"]),
@@ -33,10 +65,14 @@ def get_db2_engine():
         extra="PROTOCOL=TCPIP;SECURITY=SSL",
     )
 
-    return create_engine(f"db2+ibm_db://{uri}")
+    url = f"db2+ibm_db://{uri}"
+    return create_engine(url, **get_pool_options(url))
 
 
 def get_eis_client():
+    import ibmpairs.authentication as authentication
+    import ibmpairs.client as client
+
     return client.Client(
         authentication=authentication.OAuth2(
             username=os.environ["EIS_USERNAME"], api_key=os.environ["EIS_APIKEY"]
@@ -45,6 +81,8 @@ def get_eis_client():
 
 
 def get_eis_access_token():
+    import requests
+
     auth_response = requests.post(
         AUTH_PROVIDER_BASE + "/connect/token",
         headers={"Context-Type": "application/x-www-form-urlencoded"},
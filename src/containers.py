@@ -1,13 +1,18 @@
 import streamlit as st
 
+import math
 import os
 from datetime import timedelta, datetime
 
-import pydeck as pdk
-import matplotlib.pyplot as plt
+from io import BytesIO
 
+import cohort
 import utils
 import loaders
+import tracing
+
+# pydeck and matplotlib are imported in the functions that draw, so the
+# sidebar shows before they are loaded
 
 from dataclasses import dataclass
 
@@ -20,11 +25,34 @@ class Result:
     min_meas: int
     show_mnlso: bool
     mnlso_threshold: float
+    cohort: bool = False
+    overview: bool = False
 
 
 MAX_DATE = datetime(year=2022, month=12, day=1)
 MIN_DATE = datetime(year=2017, month=1, day=1)
 
+MAP_ZOOM = 16
+COHORT_ZOOM = 8
+
+# zoomed out far enough to show the whole of the Netherlands
+OVERVIEW_VIEW = {"latitude": 52.2, "longitude": 5.3, "zoom": 7}
+
+# the most active parcels of the window shown in cohort mode
+COHORT_MAX_PARCELS = 500
+
+# width in pixels of the weather plots, more points than this are not visible
+PLOT_DPI = 100
+PLOT_WIDTH = 10
+PLOT_POINTS = PLOT_DPI * PLOT_WIDTH
+
+SNOW_LAYER = "Snow past 24 h"
+MIN_TEMP_LAYER = "Minimum temperature past 24 h"
+MAX_TEMP_LAYER = "Maximum temperature past 24 h"
+
+MAX_CACHED_FIGURES = 128
+figure_cache = utils.LRUCache(MAX_CACHED_FIGURES)
+
 
 def make_line():
     st.write("-------")
@@ -80,6 +108,16 @@ def sidebar():
 
         make_line()
 
+        cohort_mode = st.checkbox(
+            "Cohort mode",
+            help=f"Compare the {COHORT_MAX_PARCELS} most active parcels of the window",
+        )
+        overview = st.checkbox(
+            "Overview map", help="Nitrate levels of all measurements on a grid"
+        )
+
+        make_line()
+
     return Result(
         userid,
         min_date,
@@ -87,31 +125,30 @@ def sidebar():
         min_meas,
         show_mnlso,
         mnlso_threshold,
+        cohort_mode,
+        overview,
     )
 
 
-def interactive_map(result):
-    with st.container():
-        user_meas = loaders.get_user_measurements(
-            result.userid,
-            result.min_date,
-            result.max_date,
-        )
+def interactive_map(result, data):
+    import pydeck as pdk
 
-        mean_lon = user_meas.longitude.mean()
-        mean_lat = user_meas.latitude.mean()
+    import mapdata
 
-        parcel_data = loaders.get_parcel_data(result.userid)
+    with st.container():
+        payload = mapdata.user_payload(
+            result, data, zoom=MAP_ZOOM, version=loaders.get_data_version()
+        )
 
         INITIAL_VIEW_STATE = pdk.ViewState(
-            longitude=mean_lon,
-            latitude=mean_lat,
-            zoom=16,
+            longitude=payload["view"]["longitude"],
+            latitude=payload["view"]["latitude"],
+            zoom=MAP_ZOOM,
         )
 
         parcel_layer = pdk.Layer(
             "GeoJsonLayer",
-            parcel_data,
+            payload["parcel"],
             opacity=0.7,
             filled=True,
             get_fill_color=[255, 255, 255],
@@ -119,19 +156,16 @@ def interactive_map(result):
 
         meas_layer = pdk.Layer(
             "ScatterplotLayer",
-            user_meas,
-            get_opacity="opacity",
+            payload["measurements"],
             get_position=["longitude", "latitude"],
-            get_fill_color="color",
+            get_fill_color="[r, g, b, a]",
             radius_scale=10,
             radius_min_pixels=5,
             radius_max_pixels=10,
             pickable=True,
         )
 
-        locations = loaders.get_locations(
-            mean_lat, mean_lon, thres=result.mnlso_threshold
-        )
+        locations = mapdata.points_payload(data.locations)
 
         mnlso_layer = pdk.Layer(
             "ScatterplotLayer",
@@ -139,7 +173,7 @@ def interactive_map(result):
             filled=True,
             opacity=0.5,
             get_position=["lon", "lat"],
-            get_fill_color="color",
+            get_fill_color="[r, g, b, a]",
             radius_min_pixels=10,
             radius_max_pixels=20,
             pickable=True,
@@ -153,7 +187,7 @@ def interactive_map(result):
         if result.show_mnlso:
             layers.append(mnlso_layer)
 
-        deck = pdk.Deck(
+        deck = mapdata.CompactDeck(
             initial_view_state=INITIAL_VIEW_STATE,
             layers=layers,
             api_keys={"mapbox": os.environ["MAPBOX_TOKEN"]},
@@ -167,26 +201,189 @@ def interactive_map(result):
             map_style=pdk.map_styles.LIGHT,
         )
 
-        deck.to_html()
         st.pydeck_chart(deck)
 
 
-def metrics(result):
-    user_meas = loaders.get_user_measurements(
-        result.userid,
-        result.min_date,
-        result.max_date,
+def export_panel(result):
+    import export
+
+    with st.sidebar.expander("Export"):
+        dataset = st.radio("Data", list(export.COLUMNS))
+        scope = st.radio("Parcels", ["Selected parcel", "Cohort", "All parcels"])
+        fmt = st.radio("Format", list(export.FORMATS), horizontal=True)
+
+        def generate():
+            if scope == "Selected parcel":
+                parcel_ids = [result.userid]
+            elif scope == "Cohort":
+                user_counts = loaders.get_user_ids(
+                    result.min_date, result.max_date, result.min_meas
+                )
+                parcel_ids = user_counts.counts.nlargest(
+                    COHORT_MAX_PARCELS
+                ).index.tolist()
+            else:
+                parcel_ids = None
+
+            if dataset == "Measurements":
+                chunks = export.measurement_chunks(
+                    loaders.refresh_replica(),
+                    parcel_ids,
+                    result.min_date,
+                    result.max_date,
+                )
+            else:
+                chunks = export.weather_chunks(
+                    loaders.get_db2_connection(),
+                    parcel_ids,
+                    result.min_date,
+                    result.max_date,
+                )
+
+            return export.export_bytes(chunks, fmt, export.schema(dataset))
+
+        file_name = (
+            f"{dataset.lower()}-{result.min_date:%Y%m%d}-"
+            f"{result.max_date:%Y%m%d}{export.FORMATS[fmt]}"
+        )
+
+        # the file is only written when the button is clicked, not on reruns
+        try:
+            st.download_button(
+                "Download", data=generate, file_name=file_name, on_click="ignore"
+            )
+        except RuntimeError:  # streamlit without deferred downloads
+            if st.button("Prepare export"):
+                st.download_button("Download", data=generate(), file_name=file_name)
+
+
+def overview_map():
+    import pydeck as pdk
+
+    import grid
+    import mapdata
+
+    with st.container():
+        col1, col2 = st.columns(2)
+        source = col1.radio("Source", ["measurements", "mnlso"], horizontal=True)
+        zoom = col2.select_slider(
+            "Grid level",
+            options=list(grid.ZOOMS),
+            value=loaders.get_grid_tiles().zoom_for(OVERVIEW_VIEW["zoom"]),
+        )
+
+        cells = loaders.get_overview_cells(zoom, source=source)
+        if cells.empty:
+            st.warning("No grid tiles yet, build them with `python src/grid.py`.")
+            return
+
+        layer = pdk.Layer(
+            "QuadkeyLayer",
+            mapdata.grid_payload(cells),
+            get_quadkey="quadkey",
+            get_fill_color="[r, g, b, a]",
+            opacity=0.6,
+            pickable=True,
+        )
+
+        deck = mapdata.CompactDeck(
+            initial_view_state=pdk.ViewState(**OVERVIEW_VIEW),
+            layers=[layer],
+            api_keys={"mapbox": os.environ["MAPBOX_TOKEN"]},
+            tooltip={
+                "html": (
+                    "<b>Mean nitrate</b>: {mean} <br>"
+                    "Max: {max} <br>"
+                    "Latest: {latest} ({latest_date}) <br>"
+                    "Measurements: {count} <br>"
+                )
+            },
+            map_style=pdk.map_styles.LIGHT,
+        )
+
+        st.pydeck_chart(deck)
+
+
+def cohort_map(result):
+    import pydeck as pdk
+
+    import mapdata
+
+    user_counts = loaders.get_user_ids(
+        result.min_date, result.max_date, result.min_meas
     )
+    parcel_ids = tuple(
+        sorted(user_counts.counts.nlargest(COHORT_MAX_PARCELS).index.tolist())
+    )
+
+    stats = loaders.get_cohort_stats(parcel_ids, result.min_date, result.max_date)
+    if stats.empty:
+        st.info(
+            f"No parcels with measurements between {result.min_date:%Y-%m-%d} "
+            f"and {result.max_date:%Y-%m-%d}."
+        )
+        return
+
+    with st.container():
+        col1, col2, col3 = st.columns(3)
+        col1.metric(label="Parcels", value=len(stats))
+        col2.metric(
+            label=f"Latest above {cohort.NITRATE_NORM:g} mg/L",
+            value=f"{(stats.value > cohort.NITRATE_NORM).mean():.0%}",
+        )
+        col3.metric(
+            label="Median trend (mg/L per year)",
+            value=f"{stats.trend.median():.2f}",
+            help="Theil-Sen slope of the measurements in the window",
+        )
+
+        layer = pdk.Layer(
+            "ScatterplotLayer",
+            mapdata.cohort_payload(stats),
+            get_position=["longitude", "latitude"],
+            get_fill_color="[r, g, b, a]",
+            radius_min_pixels=4,
+            radius_max_pixels=12,
+            pickable=True,
+        )
+
+        deck = mapdata.CompactDeck(
+            initial_view_state=pdk.ViewState(
+                longitude=float(stats.longitude.mean()),
+                latitude=float(stats.latitude.mean()),
+                zoom=COHORT_ZOOM,
+            ),
+            layers=[layer],
+            api_keys={"mapbox": os.environ["MAPBOX_TOKEN"]},
+            tooltip={
+                "html": (
+                    "<b>Parcel</b>: {parcel_id} <br>"
+                    "Latest nitrate: {value} ({timestamp_str}) <br>"
+                    "Trend: {trend} mg/L per year <br>"
+                    f"Share above {cohort.NITRATE_NORM:g} mg/L: {{exceedance}} <br>"
+                    "Measurements: {n_meas} <br>"
+                )
+            },
+            map_style=pdk.map_styles.LIGHT,
+        )
+
+        st.pydeck_chart(deck)
+
+
+def metrics(result, data):
+    user_meas = data.user_meas
     with st.container():
         last_measurement = user_meas.iloc[-1].copy()
         prev_measurement = last_measurement
         if len(user_meas) > 1:
             prev_measurement = user_meas.iloc[-2].copy()
 
+        # plain floats, the values are float32
+        value = round(float(last_measurement.value), 2)
         st.metric(
             label="Nitrate (User)",
-            value=last_measurement.value,
-            delta=last_measurement.value - prev_measurement.value,
+            value=value,
+            delta=round(value - float(prev_measurement.value), 2),
         )
 
         st.metric(
@@ -194,9 +391,38 @@ def metrics(result):
             value=f"{last_measurement.timestamp:%Y-%m-%d %H:%M:%S}",
         )
 
+        parcel = loaders.get_parcel_metrics(result.userid)
+        if parcel is None:
+            st.caption("The trend and exceedance of this parcel are computed nightly.")
+            return
+
+        def fmt(value, spec):
+            return "-" if math.isnan(value) else format(value, spec)
+
+        st.metric(
+            label="Trend (mg/L per year)",
+            value=fmt(parcel["trend"], "+.2f"),
+            help="Theil-Sen slope of all measurements of the parcel",
+        )
+        st.metric(
+            label="Mean of the last 30 days",
+            value=fmt(parcel["trailing_mean_30d"], ".2f"),
+            delta=fmt(
+                parcel["trailing_mean_30d"] - parcel["trailing_mean_365d"], "+.2f"
+            ),
+            help="Up to the latest measurement, delta against the mean of the "
+            "last 365 days",
+        )
+        st.metric(
+            label=f"Above {cohort.NITRATE_NORM:g} mg/L in the last 365 days",
+            value=fmt(parcel["trailing_exceedance_365d"], ".0%"),
+            help=f"{fmt(parcel['exceedance'], '.0%')} of all "
+            f"{parcel['n_meas']} measurements, up to {parcel['last_time']:%Y-%m-%d}",
+        )
+
 
-def measures(result):
-    parcel_data = loaders.get_parcel_data(result.userid)
+def measures(result, data):
+    parcel_data = data.parcel_data
 
     with st.container():
         fields_surface = [
@@ -247,15 +473,15 @@ def measures(result):
                                 st.write(measure_map[m])
 
 
-def weather(result):
+def weather(result, data):
     control, plots = st.columns([2, 5])
-    layers = loaders.get_weather_layers()
     layers_to_show = []
 
     with control:
 
         show_precipitation = st.checkbox("Show precipitation")
         resolution = None
+        show_snowfall = False
 
         if show_precipitation:
             resolution = st.radio(
@@ -266,77 +492,124 @@ def weather(result):
 
         show_temperature = st.checkbox("Show temperature")
 
-    with plots:
-        n_axes = 1 + int(show_precipitation) + int(show_temperature)
+    if show_precipitation:
+        layers_to_show.append(f"Precip past {resolution}")
 
-        weather_data = loaders.get_weather_data(
-            result.userid,
-            result.min_date,
-            result.max_date,
-        )
+        if show_snowfall:
+            layers_to_show.append(SNOW_LAYER)
+
+    if show_temperature:
+        layers_to_show.extend([MIN_TEMP_LAYER, MAX_TEMP_LAYER])
 
-        nitrate_data = loaders.get_user_measurements(
+    with plots:
+        key = (
             result.userid,
             result.min_date,
             result.max_date,
+            tuple(layers_to_show),
+            show_temperature,
+            result.show_mnlso,
+            PLOT_POINTS,
+            loaders.get_data_version(),
         )
 
-        fig, axes = plt.subplots(
-            figsize=(10, 3 * n_axes),
-            nrows=n_axes,
-            sharex=True,
+        png = figure_cache.get_or_build(
+            key,
+            lambda: weather_figure(
+                result,
+                data.user_meas,
+                show_precipitation=show_precipitation,
+                resolution=resolution,
+                show_snowfall=show_snowfall,
+                show_temperature=show_temperature,
+                layers_to_show=layers_to_show,
+            ),
         )
 
-        if n_axes > 1:
-            nitrate_ax, *others = axes
-            others = iter(others)
-        else:
-            nitrate_ax = axes
-            others = []
-
-        category_to_marker = {
-            utils.SURFACE_WATER: "^",
-            utils.GROUND_WATER: "v",
-            utils.OTHER: "*",
-        }
+        st.image(png)
 
-        for category, marker in category_to_marker.items():
-            sub = nitrate_data.loc[nitrate_data.category == category]
-            nitrate_ax.scatter(
-                sub.timestamp, sub.value, marker=marker, color="tab:blue"
-            )
 
-        nitrate_ax.set_xlim([result.min_date, result.max_date])
-        nitrate_ax.set_ylabel("NO3")
+@tracing.traced(kind="render")
+def weather_figure(
+    result,
+    nitrate_data,
+    show_precipitation,
+    resolution,
+    show_snowfall,
+    show_temperature,
+    layers_to_show,
+):
+    """Nitrate and weather plots of the user, rendered to png"""
+    from matplotlib.figure import Figure
 
-        if show_precipitation:
-            ax = next(others)
+    n_axes = 1 + int(show_precipitation) + int(show_temperature)
+
+    weather_data = loaders.get_weather_data(
+        result.userid,
+        result.min_date,
+        result.max_date,
+        layers=tuple(layers_to_show),
+        max_points=PLOT_POINTS,
+    )
+
+    # a plain Figure keeps no global pyplot state, so it can be rendered
+    # from any session thread
+    fig = Figure(figsize=(PLOT_WIDTH, 3 * n_axes), dpi=PLOT_DPI)
+    axes = fig.subplots(nrows=n_axes, sharex=True)
+
+    if n_axes > 1:
+        nitrate_ax, *others = axes
+        others = iter(others)
+    else:
+        nitrate_ax = axes
+        others = []
+
+    category_to_marker = {
+        utils.SURFACE_WATER: "^",
+        utils.GROUND_WATER: "v",
+        utils.OTHER: "*",
+    }
+
+    for category, marker in category_to_marker.items():
+        sub = nitrate_data.loc[nitrate_data.category == category]
+        nitrate_ax.scatter(
+            sub.timestamp, sub.value, marker=marker, color="tab:blue", label=category
+        )
+
+    if result.show_mnlso:
+        mnlso = loaders.get_linked_mnlso(nitrate_data, result.min_date, result.max_date)
+        nitrate_ax.scatter(
+            mnlso.timestamp, mnlso.value, marker="o", color="tab:orange", label="MNLSO"
+        )
+        nitrate_ax.legend(loc="upper left", fontsize="small")
 
-            layer = f"Precip past {resolution}"
-            sub = weather_data.loc[weather_data.layer_name == layer]
-            ax.plot(sub.timestamp, sub.value)
+    nitrate_ax.set_xlim([result.min_date, result.max_date])
+    nitrate_ax.set_ylabel("NO3")
 
-            if show_snowfall:
-                sub = weather_data.loc[weather_data.layer_name == "Snow past 24 h"]
-                ax.plot(sub.timestamp, sub.value, color="grey")
+    if show_precipitation:
+        ax = next(others)
 
-            ax.set_ylabel(layer)
+        layer = f"Precip past {resolution}"
+        sub = weather_data.loc[weather_data.layer_name == layer]
+        ax.plot(sub.timestamp, sub.value)
 
-        if show_temperature:
-            ax = next(others)
+        if show_snowfall:
+            sub = weather_data.loc[weather_data.layer_name == SNOW_LAYER]
+            ax.plot(sub.timestamp, sub.value, color="grey")
 
-            min_temp_layer = "Minimum temperature past 24 h"
-            max_temp_layer = "Maximum temperature past 24 h"
+        ax.set_ylabel(layer)
 
-            sub_min = weather_data.loc[weather_data.layer_name == min_temp_layer]
-            sub_max = weather_data.loc[weather_data.layer_name == max_temp_layer]
+    if show_temperature:
+        ax = next(others)
 
-            ax.plot(sub_min.timestamp, sub_min.value, color="tab:blue")
-            ax.plot(sub_max.timestamp, sub_max.value, color="tab:red")
+        sub_min = weather_data.loc[weather_data.layer_name == MIN_TEMP_LAYER]
+        sub_max = weather_data.loc[weather_data.layer_name == MAX_TEMP_LAYER]
 
-            ax.set_ylabel("Temperature (K)")
+        ax.plot(sub_min.timestamp, sub_min.value, color="tab:blue")
+        ax.plot(sub_max.timestamp, sub_max.value, color="tab:red")
 
-        st.pyplot(fig)
+        ax.set_ylabel("Temperature (K)")
 
-    # meetpunt, *_ = user_meas["meetpunt_code_ihw"].unique()
-    # mnlso_meas = loaders.get_mnlso_measurements(meetpunt, min_time=min_date)
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
@@ -0,0 +1,77 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import pandas as pd
+import streamlit as st
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:  # streamlit < 1.12
+    from streamlit.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import loaders
+
+
+@dataclass
+class RenderData:
+    user_meas: pd.DataFrame
+    parcel_data: dict
+    locations: pd.DataFrame
+
+
+@st.experimental_singleton
+def get_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="render-data")
+
+
+def submit(executor, func, *args, **kwargs):
+    """Run func on the pool with the script context of the calling session
+
+    The context variables are copied too, so tracing spans of func are
+    nested under the span of the caller.
+    """
+    ctx = get_script_run_ctx()
+    variables = contextvars.copy_context()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return variables.run(func, *args, **kwargs)
+
+    return executor.submit(run)
+
+
+def load_render_data(result):
+    """Fetch every dataset of the selected user once, concurrently
+
+    Only the MNLSO locations depend on another source (the mean position of
+    the measurements), so they are requested as soon as those are in. The
+    weather is left to containers.weather, which only loads the layers that
+    are shown.
+    """
+    executor = get_executor()
+
+    user_meas = submit(
+        executor,
+        loaders.get_user_measurements,
+        result.userid,
+        result.min_date,
+        result.max_date,
+    )
+    parcel_data = submit(executor, loaders.get_parcel_data, result.userid)
+
+    meas = user_meas.result()
+    locations = submit(
+        executor,
+        loaders.get_locations,
+        meas.latitude.mean(),
+        meas.longitude.mean(),
+        thres=result.mnlso_threshold,
+    )
+
+    return RenderData(
+        user_meas=meas,
+        parcel_data=parcel_data.result(),
+        locations=locations.result(),
+    )
@@ -0,0 +1,145 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class DailyCounts:
+    """Number of measurements per (day, user), kept up to date from the replica
+
+    Distinct users alone are not enough to apply a minimum number of
+    measurements, so instead of per-day user sets the sparse per-day counts
+    are stored. Any lookback window is answered by summing these counts.
+    """
+
+    def __init__(self):
+        self.counts = pd.DataFrame(
+            {
+                "day": np.array([], dtype="datetime64[ns]"),
+                "userid": np.array([], dtype=np.int64),
+                "count": np.array([], dtype=np.int64),
+            }
+        )
+        self.watermark = None
+        self._index = None
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def update(self, frame):
+        """Add the counts of a frame with ``parcel_id`` and ``timestamp`` columns"""
+        if frame.empty:
+            return
+
+        new = (
+            frame.assign(day=frame.timestamp.dt.floor("D"))
+            .groupby(["day", "parcel_id"])
+            .size()
+            .rename("count")
+            .rename_axis(["day", "userid"])
+            .reset_index()
+        )
+
+        # only the days touched by the new rows have to be merged
+        touched = self.counts.day.isin(new.day)
+        merged = (
+            pd.concat([self.counts.loc[touched], new])
+            .groupby(["day", "userid"], as_index=False)["count"]
+            .sum()
+        )
+
+        counts = pd.concat([self.counts.loc[~touched], merged], ignore_index=True)
+        counts["day"] = counts.day.astype("datetime64[ns]")
+        self.counts = counts.sort_values(["day", "userid"], ignore_index=True)
+        self._index = None
+        self._active = {}
+
+        latest = frame.timestamp.max()
+        if self.watermark is None or latest > self.watermark:
+            self.watermark = latest
+
+    def sync(self, replica):
+        """Pull in all replica rows newer than what has been counted so far"""
+        with self._lock:
+            # nothing to scan when the replica did not move
+            if (
+                self.watermark is not None
+                and replica.watermark("nitrate") <= self.watermark
+            ):
+                return
+
+            self.update(
+                replica.read(
+                    "nitrate",
+                    columns=["parcel_id", "timestamp"],
+                    after=self.watermark,
+                )
+            )
+
+    def _build_index(self):
+        """Cumulative counts sorted by (user, day) behind a single integer key"""
+        by_user = self.counts.sort_values(["userid", "day"])
+
+        days = by_user.day.to_numpy().astype("datetime64[D]").astype(np.int64)
+        users, codes = np.unique(by_user.userid.to_numpy(), return_inverse=True)
+
+        first_day = days.min(initial=0)
+        span = days.max(initial=0) - first_day + 2
+
+        return {
+            "users": users,
+            "first_day": first_day,
+            "span": span,
+            "keys": codes * span + (days - first_day),
+            "cumulative": np.concatenate([[0], np.cumsum(by_user["count"].to_numpy())]),
+        }
+
+    def window_counts(self, min_date, max_date):
+        """Measurements per user from the start of ``min_date`` up to the start
+        of ``max_date``, as two vectorized lookups in the cumulative counts"""
+        index = self._index
+        if index is None:
+            index = self._index = self._build_index()
+
+        def offset(d):
+            day = np.datetime64(d.strftime("%Y-%m-%d"), "D").astype(np.int64)
+            return np.clip(day - index["first_day"], 0, index["span"] - 1)
+
+        base = np.arange(len(index["users"])) * index["span"]
+        lo = np.searchsorted(index["keys"], base + offset(min_date), side="left")
+        hi = np.searchsorted(index["keys"], base + offset(max_date), side="left")
+
+        return pd.Series(
+            index["cumulative"][hi] - index["cumulative"][lo],
+            index=pd.Index(index["users"], name="userid"),
+            name="counts",
+        )
+
+    def active_users(self, lookback_days, min_meas):
+        """Unique users per ``lookback_days`` bucket with more than ``min_meas``
+        measurements within that same bucket, memoized until the next update"""
+        active = self._active
+        counts = self.counts
+
+        key = (lookback_days, min_meas)
+        if key not in active:
+            active[key] = self._active_users(counts, lookback_days, min_meas)
+
+        return active[key].copy()
+
+    @staticmethod
+    def _active_users(counts, lookback_days, min_meas):
+        if counts.empty:
+            return pd.Series(dtype=np.int64, name="userid")
+
+        start = counts.day.iloc[0]
+        bucket = (counts.day - start).dt.days.to_numpy() // lookback_days
+
+        per_user = counts["count"].groupby([bucket, counts.userid.to_numpy()]).sum()
+        active = (per_user > min_meas).groupby(level=0).sum()
+
+        buckets = np.arange(bucket[-1] + 1)
+        return pd.Series(
+            active.reindex(buckets, fill_value=0).to_numpy(),
+            index=pd.date_range(start, periods=len(buckets), freq=f"{lookback_days}D"),
+            name="userid",
+        ).rename_axis("timestamp")
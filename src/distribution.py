@@ -0,0 +1,153 @@
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+# same cut-off as the old full scan, higher values are only counted
+MAX_VALUE = 100.0
+BIN_WIDTH = 0.05
+
+MNLSO_VALUES_QUERY = """
+    SELECT
+        datum as timestamp,
+        waarde as value
+    FROM MNLSO
+    WHERE parameter_code = 'NO3' AND datum > :watermark
+    """
+
+
+class Histogram:
+    """Fixed-bin histogram of values in [0, max_value)
+
+    Histograms with the same bins merge by adding their counts, so it can be
+    filled one batch at a time. Quantiles and the cdf are exact up to the
+    bin width. Values outside the range are only counted.
+    """
+
+    def __init__(self, max_value=MAX_VALUE, bin_width=BIN_WIDTH):
+        self.max_value = max_value
+        self.bin_width = bin_width
+        self.counts = np.zeros(int(round(max_value / bin_width)), dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    @property
+    def count(self):
+        """Number of values in range"""
+        return int(self.counts.sum())
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+
+        inside = (values >= 0) & (values < self.max_value)
+        self.below += int((values < 0).sum())
+        self.above += int((values >= self.max_value).sum())
+
+        bins = (values[inside] / self.bin_width).astype(np.int64)
+        self.counts += np.bincount(
+            np.minimum(bins, len(self.counts) - 1), minlength=len(self.counts)
+        )
+
+    def merge(self, other):
+        if (other.max_value, other.bin_width) != (self.max_value, self.bin_width):
+            raise ValueError("histograms with different bins can not be merged")
+
+        self.counts += other.counts
+        self.below += other.below
+        self.above += other.above
+
+    def cdf(self, values):
+        """Fraction of the values in range below each of the values"""
+        values = np.clip(np.asarray(values, dtype=np.float64), 0, self.max_value)
+
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        position = values / self.bin_width
+        bins = np.minimum(position.astype(np.int64), len(self.counts) - 1)
+
+        below = cumulative[bins] + (position - bins) * self.counts[bins]
+        return below / max(cumulative[-1], 1)
+
+    def quantile(self, q):
+        """Value below which a fraction ``q`` of the values in range falls"""
+        q = np.asarray(q, dtype=np.float64)
+
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        target = q * cumulative[-1]
+
+        bins = np.searchsorted(cumulative, target, side="left") - 1
+        bins = np.clip(bins, 0, len(self.counts) - 1)
+        within = (target - cumulative[bins]) / np.maximum(self.counts[bins], 1)
+
+        return (bins + np.clip(within, 0, 1)) * self.bin_width
+
+
+class ValueDistribution:
+    """Distribution of all nitrate values, kept up to date from the sources
+
+    Measurements come from the replica, MNLSO NO3 values straight from the
+    database since they change rarely. Both are read incrementally after
+    their own watermark, the histogram is served from memory.
+    """
+
+    def __init__(self, mnlso_interval=timedelta(hours=6)):
+        self.histogram = Histogram()
+        self.mnlso_interval = mnlso_interval
+        self.watermarks = {"measurements": None, "mnlso": None}
+        self.mnlso_synced_at = None
+        self._lock = threading.Lock()
+
+    def _update(self, source, frame):
+        if frame.empty:
+            return
+
+        self.histogram.update(pd.to_numeric(frame.value, errors="coerce"))
+
+        latest = pd.to_datetime(frame.timestamp).max()
+        watermark = self.watermarks[source]
+        if watermark is None or latest > watermark:
+            self.watermarks[source] = latest
+
+    def sync_mnlso(self, engine):
+        watermark = self.watermarks["mnlso"] or datetime(year=1900, month=1, day=1)
+
+        with engine.connect() as connection:
+            frame = pd.read_sql(
+                text(MNLSO_VALUES_QUERY),
+                con=connection,
+                params={"watermark": pd.Timestamp(watermark).to_pydatetime()},
+            ).rename(columns=str.lower)
+
+        self._update("mnlso", frame)
+        self.mnlso_synced_at = datetime.now()
+
+    def sync(self, replica, engine):
+        """Add the values that came in since the last sync"""
+        with self._lock:
+            watermark = self.watermarks["measurements"]
+
+            # nothing to scan when the replica did not move
+            if watermark is None or replica.watermark("measurements") > watermark:
+                self._update(
+                    "measurements",
+                    replica.read(
+                        "measurements",
+                        columns=["timestamp", "value"],
+                        after=watermark,
+                    ),
+                )
+
+            if (
+                self.mnlso_synced_at is None
+                or datetime.now() - self.mnlso_synced_at > self.mnlso_interval
+            ):
+                self.sync_mnlso(engine)
+
+    def quantiles(self, qs=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        return pd.Series(self.histogram.quantile(qs), index=list(qs))
+
+    def normalize(self, values):
+        """Global quantile of each value, in [0, 1]"""
+        return self.histogram.cdf(values)
@@ -0,0 +1,140 @@
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import bindparam, text
+
+from loaders import DTYPES, USER_MEASUREMENT_COLUMNS, WEATHER_QUERY
+from replica import to_day
+from utils import map_category
+
+CHUNKSIZE = 50_000
+
+FORMATS = {"Parquet": ".parquet", "CSV": ".csv"}
+
+COLUMNS = {
+    "Measurements": ["parcel_id"] + USER_MEASUREMENT_COLUMNS,
+    "Weather": ["userid", "layer_id", "layer_name", "timestamp", "value"],
+}
+
+# the loader dtypes in the file. Floats keep the precision of the source, as
+# in the CSV, and ids are not narrowed since the export is not range checked
+# per chunk
+ARROW_TYPES = {
+    "category": pa.string(),
+    "float32": pa.float64(),
+    "Int16": pa.int16(),
+    "int32": pa.int64(),
+}
+
+
+def schema(dataset):
+    """Arrow schema of an export, from the dtypes of the loaders"""
+    return pa.schema(
+        [
+            (
+                column,
+                pa.timestamp("us")
+                if column == "timestamp"
+                else ARROW_TYPES[DTYPES[column]],
+            )
+            for column in COLUMNS[dataset]
+        ]
+    )
+
+
+def measurement_chunks(replica, parcel_ids, min_date, max_date, chunksize=CHUNKSIZE):
+    """Measurements of the parcels (all with None), one frame at a time"""
+    chunks = replica.scan(
+        "measurements",
+        columns=COLUMNS["Measurements"],
+        batch_size=chunksize,
+        parcel_ids=parcel_ids,
+        min_date=to_day(min_date),
+        max_date=to_day(max_date),
+    )
+
+    for chunk in chunks:
+        category = chunk.category.map(map_category, na_action="ignore")
+        yield chunk.assign(category=category)
+
+
+def weather_chunks(engine, parcel_ids, min_date, max_date, chunksize=CHUNKSIZE):
+    """WEATHERDATA rows of the parcels (all with None), streamed from the database"""
+    query = WEATHER_QUERY
+    params = {"min_date": to_day(min_date), "max_date": to_day(max_date)}
+
+    if parcel_ids is not None:
+        query += " AND userid IN :user_ids"
+        params["user_ids"] = [int(p) for p in parcel_ids]
+
+    statement = text(query + " ORDER BY userid, layer_name, meas_time")
+    if parcel_ids is not None:
+        statement = statement.bindparams(bindparam("user_ids", expanding=True))
+
+    # a server side cursor, the driver does not fetch the whole result at once
+    with engine.connect().execution_options(stream_results=True) as connection:
+        for chunk in pd.read_sql(
+            statement, con=connection, params=params, chunksize=chunksize
+        ):
+            yield chunk.rename(columns=str.lower).assign(
+                timestamp=lambda f: pd.to_datetime(f.timestamp)
+            )
+
+
+def write_parquet(chunks, path, schema):
+    rows = 0
+
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk[schema.names], preserve_index=False)
+
+            # a column with only missing values in a chunk is read as null
+            writer.write_table(table.cast(schema))
+            rows += len(chunk)
+
+    return rows
+
+
+def write_csv(chunks, path, schema):
+    rows = 0
+
+    with open(path, "w", newline="") as f:
+        f.write(",".join(schema.names) + "\n")
+
+        for chunk in chunks:
+            chunk[schema.names].to_csv(f, header=False, index=False)
+            rows += len(chunk)
+
+    return rows
+
+
+def export(chunks, fmt, schema):
+    """Write the chunks to a temporary file, returns (path, rows)
+
+    The caller removes the file. Only one chunk is in memory at a time.
+    """
+    fd, path = tempfile.mkstemp(suffix=FORMATS[fmt], prefix="export-")
+    os.close(fd)
+
+    try:
+        write = write_parquet if fmt == "Parquet" else write_csv
+        rows = write(chunks, path, schema)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path, rows
+
+
+def export_bytes(chunks, fmt, schema):
+    """The whole export file, for a download button"""
+    path, _ = export(chunks, fmt, schema)
+
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
@@ -0,0 +1,192 @@
+"""Aggregate all nitrate measurements into quadkey grid tiles
+
+    python src/grid.py [--root grid]
+
+Every measurement of the replica and every MNLSO NO3 value is binned into
+the web mercator tiles of each zoom level in ZOOMS. Per cell and source the
+count, mean, max and latest value are stored in ``root/zoom=<z>.parquet``,
+which the overview map reads, so a zoomed-out view draws a few thousand
+cells instead of every point. Run it after the nightly replica refresh.
+"""
+import argparse
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+from connect import get_db2_engine
+from replica import Replica, replace_parquet
+
+ZOOMS = (6, 8, 10, 12, 14)
+
+# web mercator is undefined at the poles
+MAX_LATITUDE = 85.05112878
+
+MNLSO_LOCATED_QUERY = """
+    SELECT
+        m.datum as timestamp,
+        m.waarde as value,
+        l.lat as latitude,
+        l.lon as longitude
+    FROM MNLSO as m
+    INNER JOIN LOCATIONS as l
+    ON l.MEETPUNT_CODE_IHW = m.MEETPUNT_CODE
+    WHERE m.PARAMETER_CODE = 'NO3'
+    """
+
+SCHEMA = pa.schema(
+    [
+        ("quadkey", pa.string()),
+        ("source", pa.dictionary(pa.int8(), pa.string())),
+        ("count", pa.int32()),
+        ("mean", pa.float32()),
+        ("max", pa.float32()),
+        ("latest", pa.float32()),
+        ("latest_time", pa.timestamp("us")),
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+
+def tile_xy(lat, lon, zoom):
+    """Web mercator tile column and row of every (lat, lon)"""
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    n = 2**zoom
+
+    x = np.floor((np.asarray(lon) + 180) / 360 * n)
+    y = np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * n)
+
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def quadkeys(x, y, zoom):
+    """Quadkey strings of tiles, one digit per zoom level"""
+    shifts = np.arange(zoom - 1, -1, -1)
+    digits = ((x[:, None] >> shifts) & 1) + 2 * ((y[:, None] >> shifts) & 1)
+
+    chars = (digits + ord("0")).astype(np.uint8)
+    return chars.view(f"S{zoom}").ravel().astype(str)
+
+
+def aggregate(points, zoom):
+    """Count, mean, max and latest value per tile of a frame of points"""
+    if points.empty:
+        return pd.DataFrame(columns=[f.name for f in SCHEMA if f.name != "source"])
+
+    points = points.sort_values("timestamp")
+    x, y = tile_xy(points.latitude.to_numpy(), points.longitude.to_numpy(), zoom)
+
+    grouped = points.groupby((x << zoom) | y, sort=True)
+    cells = grouped.value.agg(["size", "mean", "max", "last"])
+    latest_time = grouped.timestamp.last()
+
+    keys = cells.index.to_numpy()
+    return pd.DataFrame(
+        {
+            "quadkey": quadkeys(keys >> zoom, keys & (2**zoom - 1), zoom),
+            "count": cells["size"].to_numpy(),
+            "mean": cells["mean"].to_numpy(),
+            "max": cells["max"].to_numpy(),
+            "latest": cells["last"].to_numpy(),
+            "latest_time": latest_time.to_numpy(),
+        }
+    )
+
+
+def get_sources(replica, engine):
+    """Located nitrate values of the app measurements and of MNLSO"""
+    columns = ["timestamp", "value", "latitude", "longitude"]
+
+    measurements = replica.read("measurements", columns=columns)
+
+    mnlso = pd.read_sql(text(MNLSO_LOCATED_QUERY), con=engine).rename(columns=str.lower)
+    mnlso = mnlso.assign(
+        timestamp=lambda f: pd.to_datetime(f.timestamp),
+        value=lambda f: pd.to_numeric(f.value, errors="coerce"),
+        latitude=lambda f: pd.to_numeric(f.latitude, errors="coerce"),
+        longitude=lambda f: pd.to_numeric(f.longitude, errors="coerce"),
+    )
+
+    return {
+        "measurements": measurements.dropna(),
+        "mnlso": mnlso[columns].dropna(),
+    }
+
+
+def write(root, zoom, cells):
+    replace_parquet(os.path.join(root, f"zoom={zoom}.parquet"), cells, SCHEMA)
+
+
+def build(root, replica, engine, zooms=ZOOMS):
+    sources = get_sources(replica, engine)
+
+    for zoom in zooms:
+        cells = pd.concat(
+            [
+                aggregate(points, zoom).assign(source=source)
+                for source, points in sources.items()
+            ],
+            ignore_index=True,
+        )
+        write(root, zoom, cells)
+        logger.info("zoom %d: %d cells", zoom, len(cells))
+
+
+class GridTiles:
+    """The stored grid of every zoom level, read once per file change"""
+
+    def __init__(self, root, zooms=ZOOMS):
+        self.root = root
+        self.zooms = zooms
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def zoom_for(self, view_zoom, detail=3):
+        """Stored zoom with cells of about 2**-detail of a map tile"""
+        fitting = [z for z in self.zooms if z <= view_zoom + detail]
+        return max(fitting) if fitting else min(self.zooms)
+
+    def read(self, zoom, source=None):
+        path = os.path.join(self.root, f"zoom={zoom}.parquet")
+
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return pd.DataFrame(columns=SCHEMA.names)
+
+        with self._lock:
+            cached = self._tables.get(zoom)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, pq.read_table(path).to_pandas())
+                self._tables[zoom] = cached
+
+        cells = cached[1]
+        if source is not None:
+            cells = cells.loc[cells.source == source]
+
+        return cells
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=os.environ.get("GRID_DIR", "grid"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    engine = get_db2_engine()
+    replica = Replica(os.environ.get("NITRATE_REPLICA_DIR", "replica"), engine)
+    replica.refresh_all()
+
+    build(args.root, replica, engine)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Backfill WEATHERDATA for all parcels
+
+    python src/ingest.py [--checkpoint weather_checkpoint.json] [--resume]
+
+For every parcel the weather is needed from LOOKBACK before its first
+measurement up to its last one. The (user, tile) pairs that are missing days
+in WEATHERDATA are fetched per tile with multi-point EIS queries and
+appended with bulk inserts. Every finished tile is written to the checkpoint
+file, so an interrupted run continues where it stopped with ``--resume``.
+"""
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+import weather
+from connect import get_db2_engine
+from replica import Replica
+
+LOOKBACK = timedelta(days=150)
+INSERT_CHUNKSIZE = 5_000
+
+logger = logging.getLogger(__name__)
+
+
+def get_parcels(replica):
+    """Mean position and measurement range of every parcel"""
+    return (
+        replica.read(
+            "measurements", columns=["parcel_id", "timestamp", "latitude", "longitude"]
+        )
+        .dropna()
+        .groupby("parcel_id")
+        .agg(
+            lat=("latitude", "mean"),
+            lon=("longitude", "mean"),
+            first=("timestamp", "min"),
+            last=("timestamp", "max"),
+        )
+        .rename_axis("userid")
+    )
+
+
+def get_coverage(engine, layer_ids, start, end):
+    """Distinct (userid, layer_id, day) already in WEATHERDATA
+
+    Only the given layers and the days from ``start`` up to and including
+    ``end`` are counted, other rows would hide missing days.
+    """
+    statement = text(
+        """
+        SELECT DISTINCT
+            userid,
+            layer_id,
+            DATE(meas_time) as day
+        FROM WEATHERDATA
+        WHERE
+            layer_id IN :layer_ids AND
+            meas_time >= :start AND
+            meas_time < :end
+        """
+    ).bindparams(bindparam("layer_ids", expanding=True))
+
+    coverage = pd.read_sql(
+        statement,
+        con=engine,
+        params={
+            "layer_ids": [int(layer_id) for layer_id in layer_ids],
+            "start": start.floor("D").to_pydatetime(),
+            "end": (end.floor("D") + timedelta(days=1)).to_pydatetime(),
+        },
+    ).rename(columns=str.lower)
+
+    return coverage.assign(day=pd.to_datetime(coverage.day))
+
+
+def n_expected_days(tile, start, end):
+    """Number of days of the tile that fall within [start, end]"""
+    first = max(tile, start.floor("D"))
+    last = min(tile + weather.TILE_SIZE - timedelta(days=1), end.floor("D"))
+
+    return max(0, (last - first).days + 1)
+
+
+def tile_of(days):
+    """Start of the tile containing each of the days"""
+    return weather.TILE_ORIGIN + (days - weather.TILE_ORIGIN) // weather.TILE_SIZE * (
+        weather.TILE_SIZE
+    )
+
+
+def find_gaps(parcels, coverage, n_layers):
+    """Tiles per user where at least one layer misses an expected day"""
+    # only the days in the window of the user itself count
+    window = coverage.merge(parcels[["first", "last"]].reset_index(), on="userid")
+    coverage = window.loc[
+        (window.day >= (window["first"] - LOOKBACK).dt.floor("D"))
+        & (window.day <= window["last"].dt.floor("D"))
+    ]
+
+    covered = coverage.groupby(["userid", tile_of(coverage.day)]).size().to_dict()
+
+    gaps = {}
+    for userid, parcel in parcels.iterrows():
+        start = parcel["first"] - LOOKBACK
+        end = parcel["last"]
+
+        for tile in weather.get_tiles(start, end):
+            n_expected = n_expected_days(tile, start, end) * n_layers
+            if covered.get((userid, tile), 0) < n_expected:
+                gaps.setdefault(tile, []).append(userid)
+
+    return gaps
+
+
+def to_rows(users, data, existing, layer_names):
+    """WEATHERDATA rows of every user for the days that are not stored yet
+
+    ``users`` has the grid cell of every user, ``data`` the weather per cell
+    and ``existing`` the (userid, layer_id, day) already in WEATHERDATA.
+    """
+    rows = (
+        users.reset_index()
+        .merge(data, on=["cell_lat", "cell_lon"])
+        .assign(layer_id=lambda f: f.layer_id.astype(int))
+        .assign(day=lambda f: f.timestamp.dt.floor("D"))
+        .merge(existing, on=["userid", "layer_id", "day"], how="left", indicator=True)
+    )
+    rows = rows.loc[rows._merge == "left_only"]
+
+    unknown = set(rows.layer_id) - set(layer_names)
+    if unknown:
+        raise ValueError(f"no name for the weather layers {sorted(unknown)}")
+
+    return pd.DataFrame(
+        {
+            "userid": rows.userid,
+            "layer_id": rows.layer_id,
+            "layer_name": rows.layer_id.map(layer_names),
+            "meas_time": rows.timestamp,
+            "meas_value": rows.value,
+        }
+    )
+
+
+def insert(engine, rows):
+    statement = text(
+        """
+        INSERT INTO WEATHERDATA (userid, layer_id, layer_name, meas_time, meas_value)
+        VALUES (:userid, :layer_id, :layer_name, :meas_time, :meas_value)
+        """
+    )
+
+    # plain datetimes, not every driver accepts pandas Timestamps
+    records = rows.drop(columns="meas_time").to_dict("records")
+    for record, meas_time in zip(records, rows.meas_time.dt.to_pydatetime()):
+        record["meas_time"] = meas_time
+    with engine.begin() as connection:
+        for i in range(0, len(records), INSERT_CHUNKSIZE):
+            connection.execute(statement, records[i : i + INSERT_CHUNKSIZE])
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return {datetime.fromisoformat(t) for t in json.load(f)["done"]}
+    except FileNotFoundError:
+        return set()
+
+
+def save_checkpoint(path, done):
+    with open(path + ".tmp", "w") as f:
+        json.dump({"done": sorted(t.isoformat() for t in done)}, f)
+    os.replace(path + ".tmp", path)
+
+
+def run(engine, replica, checkpoint, resume=False, fetcher=None):
+    fetcher = fetcher or weather.WeatherFetcher(max_workers=8)
+
+    replica.refresh_all()
+    parcels = get_parcels(replica)
+    if parcels.empty:
+        return
+
+    layer_names = weather.LAYER_NAMES
+    coverage = get_coverage(
+        engine,
+        layer_names,
+        parcels["first"].min() - LOOKBACK,
+        parcels["last"].max(),
+    )
+
+    gaps = find_gaps(parcels, coverage, len(layer_names))
+    done = load_checkpoint(checkpoint) if resume else set()
+
+    coverage = coverage.assign(tile=tile_of(coverage.day))
+
+    for tile in sorted(gaps):
+        if tile in done:
+            continue
+
+        users = parcels.loc[gaps[tile]]
+        cells = [weather.snap(lat, lon) for lat, lon in zip(users.lat, users.lon)]
+        users = pd.DataFrame(cells, index=users.index, columns=["cell_lat", "cell_lon"])
+
+        data = fetcher.fetch_cells(sorted(set(cells)), [tile])
+        if not data.empty:
+            data = data.loc[data.timestamp < tile + weather.TILE_SIZE]
+
+        existing = coverage.loc[coverage.tile == tile, ["userid", "layer_id", "day"]]
+        rows = to_rows(users, data, existing, layer_names) if not data.empty else data
+
+        if not rows.empty:
+            insert(engine, rows)
+
+        done.add(tile)
+        save_checkpoint(checkpoint, done)
+        logger.info("tile %s: %d users, %d rows", tile.date(), len(users), len(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--checkpoint", default="weather_checkpoint.json")
+    parser.add_argument("--resume", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    engine = get_db2_engine()
+    replica = Replica(os.environ.get("NITRATE_REPLICA_DIR", "replica"), engine)
+
+    run(engine, replica, args.checkpoint, resume=args.resume)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,103 @@
+import os
 from datetime import date
 from functools import partial
 import streamlit as st
+import numpy as np
 import pandas as pd
-from utils import add_color, map_category
+from sqlalchemy import bindparam, text
+from utils import add_color, downsample, map_category
 from connect import get_db2_engine, get_cloudant_client
+from replica import Replica, to_day
+from counts import DailyCounts
+from distribution import ValueDistribution
+from analytics import ParcelMetrics
+from cohort import parcel_stats
+from grid import GridTiles
+from stations import SeriesIndex, StationIndex
+from parcels import ParcelStore
+from cache import cached
+import tracing
+
+
+# shared with the export, which streams the same data for many users
+WEATHER_QUERY = """
+    SELECT
+        userid,
+        layer_id,
+        layer_name,
+        meas_time as timestamp,
+        meas_value as value
+    FROM WEATHERDATA
+    WHERE
+        meas_time >= :min_date AND
+        meas_time <= :max_date
+    """
+
+USER_MEASUREMENT_COLUMNS = [
+    "timestamp",
+    "value",
+    "latitude",
+    "longitude",
+    "category",
+    "confidence",
+    "meetpunt_code_ihw",
+]
+
+# dtypes of the loader outputs: strings with few distinct values as
+# categoricals, measured values and coordinates as float32 (~0.5 m at the
+# latitude of the Netherlands) and ids as int32 when they fit. Integer
+# columns that can be missing use the nullable pandas types
+DTYPES = {
+    "category": "category",
+    "layer_name": "category",
+    "meetpunt_code": "category",
+    "meetpunt_code_ihw": "category",
+    "value": "float32",
+    "confidence": "float32",
+    "latitude": "float32",
+    "longitude": "float32",
+    "lat": "float32",
+    "lon": "float32",
+    "trend": "float32",
+    "exceedance": "float32",
+    "layer_id": "int32",
+    "parcel_id": "int32",
+    "userid": "int32",
+    "n_meas": "int32",
+    "season": "Int16",
+}
+
+
+def fits(values, dtype):
+    """Whether the values can be cast to the integer dtype without wrapping"""
+    dtype = pd.api.types.pandas_dtype(dtype)
+    info = np.iinfo(getattr(dtype, "numpy_dtype", dtype))
+
+    values = pd.to_numeric(values.dropna())
+    return values.empty or (values.min() >= info.min and values.max() <= info.max)
+
+
+def compact(frame):
+    """Apply DTYPES to the columns of the frame that have one
+
+    Integer columns with values out of range of their dtype are left as is.
+    """
+    dtypes = {
+        column: dtype
+        for column, dtype in DTYPES.items()
+        if column in frame.columns
+        and (
+            not pd.api.types.is_integer_dtype(dtype) or fits(frame[column], dtype)
+        )
+    }
+
+    return frame.astype(dtypes)
 
 
 @st.experimental_singleton
 def get_db2_connection():
     engine = get_db2_engine()
-    return engine
+    return tracing.instrument_engine(engine)
 
 
 @st.experimental_singleton
@@ -17,7 +105,87 @@ def get_cloudant_connection():
     return get_cloudant_client()
 
 
-@st.cache
+seen_watermark = None
+
+
+@st.experimental_singleton
+def get_replica():
+    return Replica(
+        os.environ.get("NITRATE_REPLICA_DIR", "replica"),
+        get_db2_connection(),
+    )
+
+
+def refresh_replica():
+    """Pull new rows into the replica when it is stale
+
+    Cached loaders that read from the replica are invalidated as soon as its
+    watermark moves, also when another process on the host moved it.
+    """
+    global seen_watermark
+
+    replica = get_replica()
+    replica.refresh_if_stale()
+
+    watermark = replica.watermark("measurements")
+    if watermark != seen_watermark:
+        if seen_watermark is not None:
+            for loader in REPLICA_LOADERS:
+                loader.invalidate()
+
+        seen_watermark = watermark
+
+    return replica
+
+
+def read_replica(name, **kwargs):
+    """Read from the local replica, pulling in new rows when it is stale"""
+    return refresh_replica().read(name, **kwargs)
+
+
+def get_data_version():
+    """Changes when new measurements come in, and daily for the weather
+    backfill, so anything derived from the data can be cached against it"""
+    return get_replica().watermark("measurements"), date.today()
+
+
+@st.experimental_singleton
+def get_daily_counts():
+    return DailyCounts()
+
+
+@st.experimental_singleton
+def get_value_distribution():
+    return ValueDistribution()
+
+
+@st.experimental_singleton
+def get_series_index():
+    return SeriesIndex(get_db2_connection())
+
+
+@st.experimental_singleton
+def get_grid_tiles():
+    return GridTiles(os.environ.get("GRID_DIR", "grid"))
+
+
+@st.experimental_singleton
+def get_parcel_metrics_store():
+    return ParcelMetrics(os.environ.get("ANALYTICS_PATH", "analytics/parcels.parquet"))
+
+
+@st.experimental_singleton
+def get_station_index():
+    return StationIndex(get_db2_connection(), normalize=normalize_values)
+
+
+@st.experimental_singleton
+def get_parcel_store():
+    return ParcelStore(os.environ.get("PARCEL_STORE_PATH", "parcels.sqlite"))
+
+
+@tracing.traced
+@cached(ttl=24 * 3600)
 def load_measuremaps():
     """Load mapping file from maatregelen value to actual measure"""
 
@@ -30,241 +198,214 @@ def load_measuremaps():
     return measure_map
 
 
-@st.cache
+@tracing.traced
 def get_usage_dates(lookback_days=30, min_meas=3):
-    engine = get_db2_connection()
+    replica = refresh_replica()
 
-    user_meas = (
-        pd.read_sql(
-            f"""
-            SELECT
-                m.parcel_id as userid,
-                n."timestamp"
-            FROM NITRATEAPP as n
-            INNER JOIN NITRATE_ID_MAPPING as m
-            ON n.id = m.nitrate_id
-            WHERE m.parcel_id IN (
-                SELECT t.parcel_id
-                FROM NITRATE_ID_MAPPING as t
-                GROUP BY t.parcel_id
-                HAVING COUNT(*) > {min_meas}
-            )
-            """,
-            con=engine,
-        )
-        .set_index("timestamp")
-        .squeeze()
-    )
+    daily_counts = get_daily_counts()
+    daily_counts.sync(replica)
 
-    def number_active_users(x):
-        return len(x.unique())
+    return daily_counts.active_users(lookback_days, min_meas)
 
-    return user_meas.resample(f"{lookback_days}D").apply(number_active_users)
 
-
-@st.cache
+@tracing.traced
 def get_user_ids(min_date, max_date, min_meas):
     """Get user counts from the database"""
+    replica = refresh_replica()
+
+    daily_counts = get_daily_counts()
+    daily_counts.sync(replica)
+
+    counts = daily_counts.window_counts(min_date, max_date)
+
+    return counts.loc[counts > min_meas].to_frame().astype(int)
+
+
+@tracing.traced
+@cached(ttl=3600)
+def get_weather_data(user_id, min_date, max_date, layers=None, max_points=None):
+    """Weather of a user, optionally only for the given layer names
+
+    With ``max_points`` every layer is downsampled to at most that many
+    points, e.g. the width in pixels of the plot it is drawn in.
+    """
     eng = get_db2_connection()
 
-    user_counts = (
-        pd.read_sql(
-            f"""
-            SELECT
-                m.parcel_id as userid,
-                count(*) as counts
-            FROM NITRATEAPP as n
-            INNER JOIN NITRATE_ID_MAPPING as m
-            ON n.id = m.nitrate_id
-            WHERE
-                n."timestamp" >= '{min_date:%Y-%m-%d}' AND
-                n."timestamp" <= '{max_date:%Y-%m-%d}'
-            GROUP BY m.parcel_id
-            HAVING COUNT(*) > {min_meas}
-            """,
-            con=eng,
-        )
-        .set_index("userid")
-        .astype(int)
+    query = WEATHER_QUERY + " AND userid = :user_id"
+    params = {
+        "user_id": int(user_id),
+        "min_date": to_day(min_date),
+        "max_date": to_day(max_date),
+    }
+
+    if layers is not None:
+        if not layers:
+            columns = ["layer_id", "layer_name", "timestamp", "value"]
+            return pd.DataFrame(columns=columns)
+
+        query += " AND layer_name IN :layers"
+        params["layers"] = list(layers)
+
+    statement = text(query + " ORDER BY layer_name, meas_time")
+    if layers is not None:
+        statement = statement.bindparams(bindparam("layers", expanding=True))
+
+    weather_data = (
+        pd.read_sql(statement, con=eng, params=params)
+        .rename(columns=str.lower)
+        .drop(columns="userid")
+        .assign(timestamp=lambda f: pd.to_datetime(f.timestamp))
     )
 
-    return user_counts
+    if max_points is None or weather_data.empty:
+        return compact(weather_data)
 
+    return pd.concat(
+        [
+            downsample(layer, max_points)
+            for _, layer in weather_data.groupby("layer_name", sort=False)
+        ],
+        ignore_index=True,
+    ).pipe(compact)
 
-@st.cache
-def get_weather_data(user_id, min_date, max_date):
-    eng = get_db2_connection()
 
-    return pd.read_sql(
-        f"""
-            SELECT
-                layer_id,
-                layer_name,
-                meas_time as timestamp,
-                meas_value as value
-            FROM WEATHERDATA
-            WHERE
-                userid = {user_id} AND
-                meas_time >= '{min_date:%Y-%m-%d}' AND
-                meas_time <= '{max_date:%Y-%m-%d}'
-            """,
-        con=eng,
-    ).rename(columns=str.lower)
-
-
-@st.cache(allow_output_mutation=True)
+@tracing.traced
+@cached(ttl=15 * 60)
 def get_user_measurements(user_id, min_date, max_date):
-    eng = get_db2_connection()
-
     return (
-        pd.read_sql(
-            f"""
-            SELECT
-                n."timestamp",
-                n."value",
-                n.latitude,
-                n.longitude,
-                n.category,
-                n.confidence,
-                n.meetpunt_code_ihw
-            FROM NITRATEAPP_NL_WITH_LOC_ID as n
-            INNER JOIN NITRATE_ID_MAPPING as m
-            ON n.id = m.nitrate_id
-            WHERE
-                m.parcel_id = {user_id} AND
-                n."timestamp" >= '{min_date:%Y-%m-%d}' AND
-                n."timestamp" <= '{max_date:%Y-%m-%d}'
-            ORDER BY n."timestamp"
-            """,
-            con=eng,
+        read_replica(
+            "measurements",
+            columns=USER_MEASUREMENT_COLUMNS,
+            parcel_id=user_id,
+            min_date=to_day(min_date),
+            max_date=to_day(max_date),
         )
         .sort_values(by=["timestamp"])
         .dropna()
-        .rename(columns=str.lower)
-        .assign(timestamp_str=lambda f: f.timestamp.dt.strftime("%Y-%m-%d"))
-        .pipe(add_color, add_opacity=True)
+        .reset_index(drop=True)
+        .pipe(add_color, add_opacity=True, packed=True, normalize=normalize_values)
         .assign(category=lambda f: f.category.map(map_category))
+        .pipe(compact)
     )
 
 
-@st.cache
-def get_all_values():
-    eng = get_db2_connection()
+@tracing.traced
+@cached(ttl=15 * 60)
+def get_cohort_stats(parcel_ids, min_date, max_date):
+    """Statistics of many parcels, their measurements are read in one scan"""
+    meas = read_replica(
+        "measurements",
+        columns=["parcel_id", "timestamp", "value", "latitude", "longitude"],
+        parcel_ids=parcel_ids,
+        min_date=to_day(min_date),
+        max_date=to_day(max_date),
+    ).dropna()
+
+    return (
+        parcel_stats(meas)
+        .pipe(add_color, packed=True, normalize=normalize_values)
+        .pipe(compact)
+    )
+
+
+@tracing.traced
+def get_overview_cells(zoom, source="measurements"):
+    """Pre-aggregated grid cells of one zoom level, colored by their mean"""
+    cells = get_grid_tiles().read(zoom, source=source)
+
+    return cells.assign(value=cells["mean"]).pipe(
+        add_color, packed=True, normalize=normalize_values
+    )
+
+
+@tracing.traced
+def get_parcel_metrics(parcel_id):
+    """Nightly metrics of one parcel (see analytics.py), None before the first run"""
+    return get_parcel_metrics_store().get(parcel_id)
+
+
+@tracing.traced
+def get_nitrate_distribution():
+    """Distribution of all measurement and MNLSO nitrate values"""
+    replica = refresh_replica()
+
+    distribution = get_value_distribution()
+    distribution.sync(replica, get_db2_connection())
+
+    return distribution
+
 
-    return pd.read_sql(
-        """
-            select
-                *
-            from (
-                select
-                    n."value" as val
-                from NITRATEAPP as n
-                UNION
-                select
-                    m.waarde as val
-                from MNLSO as m
-            )
-            where val < 100
-            """,
-        con=eng,
-    ).squeeze()
-
-
-@st.cache
+def normalize_values(values):
+    """Global quantile of every value, used to color the measurements"""
+    return get_nitrate_distribution().normalize(values)
+
+
+@tracing.traced
 def get_mnlso_measurements(meetpunt, min_time=date(year=1900, month=1, day=1)):
-    eng = get_db2_connection()
+    """NO3 series of one station after min_time, from the in-memory index"""
+    return compact(get_series_index().series([meetpunt], after=to_day(min_time)))
 
-    return (
-        pd.read_sql(
-            f"""
-            SELECT
-                datum as timestamp,
-                groeiseizoen as season,
-                waarde as value,
-                meetpunt_code,
-                'MNLSO' as category
-            FROM MNLSO
-            WHERE meetpunt_code = '{meetpunt}' AND parameter_code = 'NO3'
-            AND datum > '{min_time:%Y-%m-%d}'
-            ORDER BY datum
-            """,
-            con=eng,
-        )
-        .rename(columns=str.lower)
-        .assign(timestamp=lambda f: pd.to_datetime(f.timestamp))
-        .dropna()
+
+@tracing.traced
+def get_linked_mnlso(user_meas, min_time=None, max_time=None):
+    """NO3 series of the stations linked to the user measurements"""
+    codes = user_meas.meetpunt_code_ihw.dropna().unique()
+
+    series = get_series_index().series(
+        codes,
+        after=to_day(min_time) if min_time is not None else None,
+        until=to_day(max_time) if max_time is not None else None,
     )
 
+    return compact(series)
+
 
-@st.cache
+@tracing.traced
 def get_parcel_data(parcel_id):
     client = get_cloudant_connection()
     database = client["parcels"]
 
+    store = get_parcel_store()
+    store.sync_if_stale(database)
+
+    parcel = store.get(parcel_id)
+    if parcel is not None:
+        return parcel
+
+    # not synced yet, e.g. created after the last sync
     docs = database.get_query_result({"properties.OBJECTID": {"$eq": parcel_id}})
 
     head, *_ = docs
     return head
 
 
-@st.cache
+@tracing.traced
 def get_locations(lat, lon, thres=0.3):
-    connection = get_db2_connection()
+    return compact(get_station_index().within(lat, lon, thres))
 
-    return (
-        pd.read_sql(
-            f"""
-            WITH recent_mnlso as (
-                SELECT
-                    MEETPUNT_CODE,
-                    DATUM,
-                    WAARDE
-                FROM MNLSO as m
-                WHERE m.PARAMETER_CODE = 'NO3' and m.DATUM = (
-                    SELECT max(mm.DATUM)
-                    FROM MNLSO as mm
-                    WHERE m.MEETPUNT_CODE = mm.MEETPUNT_CODE
-                )
-            )
-            SELECT
-                r.MEETPUNT_CODE,
-                r.DATUM as timestamp,
-                r.WAARDE as value,
-                CAST(lat as DOUBLE) as lat,
-                CAST(lon as DOUBLE) as lon,
-                'MNLSO' as category
-            FROM recent_mnlso as r
-            INNER JOIN LOCATIONS as l
-            ON l.MEETPUNT_CODE_IHW = r.MEETPUNT_CODE
-            WHERE
-                abs(CAST(lat as DOUBLE) - {lat}) < {thres} AND
-                abs(CAST(lon as DOUBLE) - {lon}) < {thres}
-            """,
-            con=connection,
-        )
-        .dropna()
-        .rename(columns=str.lower)
-        .assign(timestamp=lambda f: pd.to_datetime(f.timestamp))
-        .assign(timestamp_str=lambda f: f.timestamp.dt.strftime("%Y-%m-%d"))
-        .pipe(add_color)
-    )
 
-
-@st.cache
+@tracing.traced
+@cached(ttl=24 * 3600)
 def get_weather_layers():
     connection = get_db2_connection()
 
     return (
         pd.read_sql(
-            """
-            SELECT DISTINCT
-                layer_id,
-                layer_name
-            FROM weatherdata
-            """,
+            text(
+                """
+                SELECT DISTINCT
+                    layer_id,
+                    layer_name
+                FROM weatherdata
+                """
+            ),
             con=connection,
         )
         .set_index("layer_name")
         .squeeze()
         .to_dict()
     )
+
+
+# cached loaders that have to be invalidated when the replica changes
+REPLICA_LOADERS = [get_user_measurements, get_cohort_stats]
@@ -1,24 +1,30 @@
-import os
-import matplotlib.pyplot as plt
-
-from datetime import timedelta, datetime
-
-import pandas as pd
 import streamlit as st
-import pydeck as pdk
 
-import loaders
-import utils
-import weather
+import containers
+import context
+import tracing
+import warmup
 
 
-import containers
+@st.experimental_singleton
+def start_warmup():
+    return warmup.start()
 
 
 def main():
+    start_warmup()
+
     st.header("Deltares Nitrate APP")
 
-    result = containers.sidebar()
+    with tracing.span("sidebar"):
+        result = containers.sidebar()
+
+    if result.overview:
+        with tracing.span("overview_map"):
+            containers.overview_map()
+
+        tracing.debug_panel()
+        return
 
     if result.userid is None:
         st.error(
@@ -28,10 +34,29 @@ def main():
         st.warning("Try choosing a wider window or a different number of measurements!")
         return
 
-    containers.interactive_map(result)
-    containers.metrics(result)
-    containers.weather(result)
-    containers.measures(result)
+    with tracing.span("export_panel"):
+        containers.export_panel(result)
+
+    if result.cohort:
+        with tracing.span("cohort_map"):
+            containers.cohort_map(result)
+
+        tracing.debug_panel()
+        return
+
+    with tracing.span("load_render_data"):
+        data = context.load_render_data(result)
+
+    for section in [
+        containers.interactive_map,
+        containers.metrics,
+        containers.weather,
+        containers.measures,
+    ]:
+        with tracing.span(section.__name__):
+            section(result, data)
+
+    tracing.debug_panel()
 
 
 main()
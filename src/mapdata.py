@@ -0,0 +1,217 @@
+import json
+import math
+import numpy as np
+import pydeck as pdk
+from pydeck.bindings.json_tools import default_serialize
+
+from utils import LRUCache
+
+# columns of the point layers that the map and its tooltip actually use
+POINT_COLUMNS = [
+    "longitude",
+    "latitude",
+    "lon",
+    "lat",
+    "value",
+    "timestamp_str",
+    "category",
+]
+COLOR_COLUMNS = ["r", "g", "b", "a"]
+
+# one point per parcel in cohort mode, with the statistics for the tooltip
+COHORT_COLUMNS = [
+    "parcel_id",
+    "longitude",
+    "latitude",
+    "value",
+    "timestamp_str",
+    "n_meas",
+    "trend",
+    "exceedance",
+]
+
+# ~0.1 m at the latitude of the Netherlands, well below a pixel at zoom 20
+COORDINATE_DECIMALS = 6
+
+MAX_CACHED_PAYLOADS = 256
+
+
+def zoom_tolerance(zoom, latitude, pixels=1.0):
+    """Size in degrees of ``pixels`` screen pixels at a web mercator zoom level"""
+    degrees_per_pixel = 360 / (256 * 2**zoom)
+    return pixels * degrees_per_pixel * math.cos(math.radians(latitude))
+
+
+def simplify_line(points, tolerance):
+    """Ramer-Douglas-Peucker simplification of an (n, 2) array of points"""
+    if len(points) < 3:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start, end = points[first], points[last]
+        segment = end - start
+        between = points[first + 1 : last] - start
+
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(between[:, 0], between[:, 1])
+        else:
+            cross = segment[0] * between[:, 1] - segment[1] * between[:, 0]
+            distances = np.abs(cross) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return points[keep]
+
+
+def simplify_ring(ring, tolerance):
+    points = simplify_line(np.asarray(ring, dtype=np.float64), tolerance)
+
+    # a ring needs at least four positions (a closed triangle) to stay valid
+    if len(points) < 4:
+        points = np.asarray(ring, dtype=np.float64)
+
+    return np.round(points, COORDINATE_DECIMALS).tolist()
+
+
+def simplify_geometry(geometry, tolerance):
+    if geometry is None:
+        return geometry
+
+    kind = geometry["type"]
+    coordinates = geometry["coordinates"]
+
+    if kind == "Polygon":
+        coordinates = [simplify_ring(ring, tolerance) for ring in coordinates]
+    elif kind == "MultiPolygon":
+        coordinates = [
+            [simplify_ring(ring, tolerance) for ring in polygon]
+            for polygon in coordinates
+        ]
+    else:
+        return geometry
+
+    return {"type": kind, "coordinates": coordinates}
+
+
+def parcel_payload(parcel_data, tolerance):
+    """The parcel as a bare GeoJSON feature, simplified to ``tolerance``
+
+    The properties are left out, the parcel layer only draws the outline.
+    """
+    return {
+        "type": "Feature",
+        "geometry": simplify_geometry(parcel_data.get("geometry"), tolerance),
+        "properties": {},
+    }
+
+
+def rounded(frame, decimals):
+    """Round columns for JSON, float32 is widened first so 13.11 stays 13.11"""
+    decimals = {c: d for c, d in decimals.items() if c in frame}
+    widened = {c: "float64" for c in decimals if frame[c].dtype == np.float32}
+
+    return frame.astype(widened).round(decimals)
+
+
+def with_date(frame):
+    """Add the timestamp_str the tooltips show, derived only when rendering"""
+    if "timestamp" not in frame or "timestamp_str" in frame:
+        return frame
+
+    return frame.assign(timestamp_str=frame.timestamp.dt.strftime("%Y-%m-%d"))
+
+
+def points_payload(frame):
+    """Only the columns the point layers need, as JSON-ready records"""
+    frame = with_date(frame)
+    columns = [c for c in POINT_COLUMNS + COLOR_COLUMNS if c in frame]
+    frame = frame[columns]
+
+    decimals = {c: COORDINATE_DECIMALS for c in ["longitude", "latitude", "lon", "lat"]}
+    decimals["value"] = 2
+
+    return rounded(frame, decimals).to_dict("records")
+
+
+GRID_COLUMNS = ["quadkey", "count", "mean", "max", "latest", "latest_date"]
+
+
+def grid_payload(cells):
+    """Grid cells as JSON-ready records for a QuadkeyLayer"""
+    frame = cells.assign(latest_date=cells.latest_time.dt.strftime("%Y-%m-%d"))
+
+    return rounded(
+        frame[GRID_COLUMNS + COLOR_COLUMNS], {"mean": 2, "max": 2, "latest": 2}
+    ).to_dict("records")
+
+
+def cohort_payload(stats):
+    """Per-parcel statistics as JSON-ready records, a missing trend as null"""
+    frame = rounded(
+        with_date(stats)[COHORT_COLUMNS + COLOR_COLUMNS],
+        {
+            "longitude": COORDINATE_DECIMALS,
+            "latitude": COORDINATE_DECIMALS,
+            "value": 2,
+            "trend": 2,
+            "exceedance": 2,
+        },
+    )
+    # a missing trend is null in the json, not NaN
+    trend = frame.trend.astype(object).where(frame.trend.notna(), None)
+    frame = frame.assign(trend=trend)
+
+    return frame.to_dict("records")
+
+
+class CompactDeck(pdk.Deck):
+    """Deck that serializes without the indentation pydeck adds by default
+
+    st.pydeck_chart sends the output of ``to_json`` to the browser as is, and
+    with one line per record field the indentation is most of the payload.
+    """
+
+    def to_json(self):
+        return json.dumps(
+            self,
+            sort_keys=True,
+            default=default_serialize,
+            separators=(",", ":"),
+        )
+
+
+payload_cache = LRUCache(MAX_CACHED_PAYLOADS)
+
+
+def user_payload(result, data, zoom, version=None):
+    """Measurement points and parcel outline of the selected user and window"""
+
+    def build():
+        user_meas = data.user_meas
+        tolerance = zoom_tolerance(zoom, user_meas.latitude.mean())
+
+        return {
+            "measurements": points_payload(user_meas),
+            "parcel": parcel_payload(data.parcel_data, tolerance),
+            "view": {
+                "longitude": float(user_meas.longitude.mean()),
+                "latitude": float(user_meas.latitude.mean()),
+            },
+        }
+
+    key = (result.userid, result.min_date, result.max_date, zoom, version)
+    return payload_cache.get_or_build(key, build)
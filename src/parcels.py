@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class ParcelStore:
+    """Parcel documents on local disk, keyed by ``properties.OBJECTID``
+
+    The store is filled from the ``_changes`` feed of the Cloudant ``parcels``
+    database. Only changes after the last seen sequence are requested, so a
+    sync after the first one is cheap. ``database`` can be anything with a
+    cloudant-style ``changes(since=..., include_docs=True, limit=...)``.
+
+    The first sync reads the whole database, it is run by ``main`` or the
+    warm-up at startup and not by a request.
+    """
+
+    def __init__(self, path, sync_interval=timedelta(hours=1)):
+        self.sync_interval = sync_interval
+        self.last_sync = None
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS parcels (
+                    doc_id TEXT PRIMARY KEY,
+                    objectid INTEGER,
+                    doc TEXT
+                )
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS parcels_objectid ON parcels (objectid)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint "
+                "(name TEXT PRIMARY KEY, seq TEXT)"
+            )
+
+    def last_seq(self):
+        row = self._connection.execute(
+            "SELECT seq FROM checkpoint WHERE name = 'parcels'"
+        ).fetchone()
+
+        return row[0] if row else "0"
+
+    @property
+    def initialized(self):
+        """Whether a sync has read the whole changes feed at least once"""
+        row = self._connection.execute(
+            "SELECT 1 FROM checkpoint WHERE name = 'initial'"
+        ).fetchone()
+
+        return row is not None
+
+    def _apply(self, changes, seq):
+        upserts = []
+        deletes = []
+
+        for change in changes:
+            doc_id = change["id"]
+            if doc_id.startswith("_design/"):
+                continue
+
+            if change.get("deleted"):
+                deletes.append((doc_id,))
+                continue
+
+            doc = change["doc"]
+            objectid = doc.get("properties", {}).get("OBJECTID")
+            upserts.append((doc_id, objectid, json.dumps(doc)))
+
+        # the documents and the sequence they belong to are committed together
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO parcels VALUES (?, ?, ?)", upserts
+            )
+            self._connection.executemany(
+                "DELETE FROM parcels WHERE doc_id = ?", deletes
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO checkpoint VALUES ('parcels', ?)", (seq,)
+            )
+
+        return len(upserts) + len(deletes)
+
+    def sync(self, database, batch_size=1000):
+        """Apply all changes since the last sync, returns the number applied"""
+        applied = 0
+
+        with self._lock:
+            while True:
+                feed = database.changes(
+                    since=self.last_seq(), include_docs=True, limit=batch_size
+                )
+                changes = list(feed)
+
+                if not changes:
+                    break
+
+                applied += self._apply(changes, str(feed.last_seq))
+
+                if len(changes) < batch_size:
+                    break
+
+            if not self.initialized:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO checkpoint VALUES ('initial', ?)",
+                        (self.last_seq(),),
+                    )
+
+            self.last_sync = datetime.now()
+
+        return applied
+
+    def sync_if_stale(self, database):
+        """Incremental sync, the first full sync is left to ``main``"""
+        if not self.initialized:
+            return
+
+        stale = self.last_sync is None
+        if stale or datetime.now() - self.last_sync > self.sync_interval:
+            self.sync(database)
+
+    def get(self, objectid):
+        row = self._connection.execute(
+            "SELECT doc FROM parcels WHERE objectid = ? LIMIT 1", (int(objectid),)
+        ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+
+def main():
+    """Sync the parcel store with Cloudant, run it before starting the app"""
+    import argparse
+
+    from connect import get_cloudant_client
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--path", default=os.environ.get("PARCEL_STORE_PATH", "parcels.sqlite")
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    applied = ParcelStore(args.path).sync(get_cloudant_client()["parcels"])
+    logger.info("applied %d changes", applied)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+# parcels are hashed into a fixed number of buckets so that a lookup for a
+# single parcel only has to open the files of one bucket
+N_BUCKETS = 64
+
+START_WATERMARK = datetime(year=1900, month=1, day=1)
+
+logger = logging.getLogger(__name__)
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("bucket", pa.int32()), ("year", pa.int32())]), flavor="hive"
+)
+
+DATASETS = {
+    "nitrate": {
+        "query": """
+            SELECT
+                n.id,
+                m.parcel_id,
+                n."timestamp"
+            FROM NITRATEAPP as n
+            INNER JOIN NITRATE_ID_MAPPING as m
+            ON n.id = m.nitrate_id
+            WHERE n."timestamp" >= :watermark
+            ORDER BY n."timestamp"
+            """,
+        "schema": pa.schema(
+            [
+                ("id", pa.int64()),
+                ("parcel_id", pa.int64()),
+                ("timestamp", pa.timestamp("us")),
+            ]
+        ),
+    },
+    "measurements": {
+        "query": """
+            SELECT
+                n.id,
+                m.parcel_id,
+                n."timestamp",
+                n."value",
+                n.latitude,
+                n.longitude,
+                n.category,
+                n.confidence,
+                n.meetpunt_code_ihw
+            FROM NITRATEAPP_NL_WITH_LOC_ID as n
+            INNER JOIN NITRATE_ID_MAPPING as m
+            ON n.id = m.nitrate_id
+            WHERE n."timestamp" >= :watermark
+            ORDER BY n."timestamp"
+            """,
+        "schema": pa.schema(
+            [
+                ("id", pa.int64()),
+                ("parcel_id", pa.int64()),
+                ("timestamp", pa.timestamp("us")),
+                ("value", pa.float64()),
+                ("latitude", pa.float64()),
+                ("longitude", pa.float64()),
+                ("category", pa.string()),
+                ("confidence", pa.float64()),
+                ("meetpunt_code_ihw", pa.string()),
+            ]
+        ),
+    },
+}
+
+
+def to_day(d):
+    """Midnight of the given date, as DB2 interprets a 'YYYY-MM-DD' literal"""
+    return datetime(year=d.year, month=d.month, day=d.day)
+
+
+def replace_parquet(path, frame, schema):
+    """Write the columns of ``schema`` to a Parquet file at ``path``
+
+    The file is written under a unique temporary name in the same directory
+    and renamed over ``path``, so readers never see a half written file and
+    concurrent writers do not write to the same file.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    table = pa.Table.from_pandas(frame[schema.names], preserve_index=False)
+
+    # the dot hides it from the dataset discovery
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".parquet.tmp")
+    os.close(fd)
+    try:
+        pq.write_table(table.cast(schema), tmp, compression="zstd")
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class Replica:
+    """Local, partitioned Parquet copy of the joined nitrate tables
+
+    Every dataset in ``DATASETS`` is stored under ``root/<name>`` with hive
+    partitions on the parcel bucket and the measurement year. A refresh pulls
+    the rows from the stored ``"timestamp"`` watermark on, the ones at the
+    watermark that were copied before are skipped by id. Rows that arrive
+    later with an older timestamp are not picked up.
+
+    A refresh holds a file lock on the root, so refreshes from other
+    processes on the host wait for it. Its chunks are written to a staging
+    directory and moved in together with the new watermark, see ``_commit``.
+    """
+
+    def __init__(self, root, engine, chunksize=100_000):
+        self.root = root
+        self.engine = engine
+        self.chunksize = chunksize
+        self.last_refresh = None
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _watermark_path(self, name):
+        return os.path.join(self._path(name), "_watermark.json")
+
+    def _staging_path(self, name):
+        # the dataset discovery skips files and directories starting with _
+        return os.path.join(self._path(name), "_staging")
+
+    def watermark(self, name):
+        try:
+            with open(self._watermark_path(name)) as f:
+                return datetime.fromisoformat(json.load(f)["watermark"])
+        except FileNotFoundError:
+            return START_WATERMARK
+
+    def _set_watermark(self, name, watermark):
+        path = self._watermark_path(name)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"watermark": watermark.isoformat()}, f)
+        os.replace(path + ".tmp", path)
+
+    @property
+    def initialized(self):
+        """Whether every dataset has been copied at least once"""
+        return all(self.watermark(name) > START_WATERMARK for name in DATASETS)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Exclusive lock on the replica, across the processes on the host"""
+        os.makedirs(self.root, exist_ok=True)
+
+        with self._lock, open(os.path.join(self.root, "_refresh.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _to_table(self, name, frame):
+        schema = DATASETS[name]["schema"]
+        frame = frame.rename(columns=str.lower).assign(
+            timestamp=lambda f: pd.to_datetime(f.timestamp)
+        )
+        table = pa.Table.from_pandas(frame[schema.names], preserve_index=False)
+        table = table.cast(schema)
+
+        return table.append_column(
+            "bucket", pa.array(frame.parcel_id.to_numpy() % N_BUCKETS, pa.int32())
+        ).append_column(
+            "year", pa.array(frame.timestamp.dt.year.to_numpy(), pa.int32())
+        )
+
+    def _new_rows(self, name, table):
+        """Rows of the table whose id is not in the replica yet"""
+        earliest = pc.min(table["timestamp"]).as_py()
+        existing = self.dataset(name).to_table(
+            columns=["id"],
+            filter=(ds.field("year") >= earliest.year)
+            & (ds.field("timestamp") >= pa.scalar(earliest, pa.timestamp("us"))),
+        )
+
+        return table.filter(pc.invert(pc.is_in(table["id"], value_set=existing["id"])))
+
+    def _commit(self, name, staging, watermark):
+        """Move the staged files into the dataset and set the watermark
+
+        The watermark is written into the staging directory first. From then
+        on the commit is completed by ``_recover`` when it is interrupted, a
+        staging directory without it is dropped, so no row is added twice.
+        """
+        os.makedirs(staging, exist_ok=True)
+
+        path = os.path.join(staging, "_commit.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"watermark": watermark.isoformat()}, f)
+        os.replace(path + ".tmp", path)
+
+        self._apply(name, staging)
+
+    def _apply(self, name, staging):
+        with open(os.path.join(staging, "_commit.json")) as f:
+            watermark = datetime.fromisoformat(json.load(f)["watermark"])
+
+        for directory, _, files in os.walk(staging):
+            for file in files:
+                if file.startswith("_"):
+                    continue
+
+                source = os.path.join(directory, file)
+                relative = os.path.relpath(source, staging)
+                target = os.path.join(self._path(name), relative)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(source, target)
+
+        self._set_watermark(name, max(watermark, self.watermark(name)))
+        shutil.rmtree(staging)
+
+    def _recover(self, name):
+        """Complete the commits of an interrupted refresh, drop its other chunks"""
+        root = self._staging_path(name)
+        if not os.path.isdir(root):
+            return
+
+        for entry in sorted(os.listdir(root)):
+            staging = os.path.join(root, entry)
+
+            if os.path.exists(os.path.join(staging, "_commit.json")):
+                logger.warning("completing the interrupted commit %s", staging)
+                self._apply(name, staging)
+            else:
+                shutil.rmtree(staging)
+
+    def _refresh(self, name):
+        self._recover(name)
+
+        watermark = pd.Timestamp(self.watermark(name))
+        staging = os.path.join(self._staging_path(name), uuid.uuid4().hex)
+        os.makedirs(self._path(name), exist_ok=True)
+
+        added = 0
+        try:
+            with self.engine.connect() as connection:
+                chunks = pd.read_sql(
+                    text(DATASETS[name]["query"]),
+                    con=connection,
+                    params={"watermark": watermark.to_pydatetime()},
+                    chunksize=self.chunksize,
+                )
+
+                for chunk in chunks:
+                    if chunk.empty:
+                        continue
+
+                    table = self._to_table(name, chunk)
+                    latest = pd.Timestamp(pc.max(table["timestamp"]).as_py())
+                    watermark = max(watermark, latest)
+
+                    # left behind by a refresh from before the staging
+                    table = self._new_rows(name, table)
+                    if not table.num_rows:
+                        continue
+
+                    ds.write_dataset(
+                        table,
+                        staging,
+                        format="parquet",
+                        partitioning=PARTITIONING,
+                        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+                        existing_data_behavior="overwrite_or_ignore",
+                    )
+                    added += table.num_rows
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        if added or watermark > pd.Timestamp(self.watermark(name)):
+            self._commit(name, staging, watermark.to_pydatetime())
+
+        return added
+
+    def refresh(self, name):
+        """Append all new rows from the watermark on, returns the rows added"""
+        with self._locked():
+            return self._refresh(name)
+
+    def refresh_all(self):
+        with self._locked():
+            added = {name: self._refresh(name) for name in DATASETS}
+            self.last_refresh = datetime.now()
+
+        return added
+
+    def refresh_if_stale(self, max_age=timedelta(minutes=15)):
+        """Incremental refresh, the first full copy is left to ``main``"""
+        if not self.initialized:
+            return
+
+        if self.last_refresh is None or datetime.now() - self.last_refresh > max_age:
+            self.refresh_all()
+
+    def dataset(self, name):
+        schema = DATASETS[name]["schema"]
+        for field in PARTITIONING.schema:
+            schema = schema.append(field)
+
+        os.makedirs(self._path(name), exist_ok=True)
+        return ds.dataset(
+            self._path(name),
+            schema=schema,
+            format="parquet",
+            partitioning=PARTITIONING,
+        )
+
+    def _predicate(
+        self,
+        parcel_id=None,
+        min_date=None,
+        max_date=None,
+        after=None,
+        parcel_ids=None,
+    ):
+        """Filter expression, pushed down to the Parquet scan
+
+        ``min_date`` and ``max_date`` are inclusive, ``after`` is an exclusive
+        lower bound on the exact timestamp. ``parcel_ids`` reads many parcels
+        in a single scan.
+        """
+        timestamp = ds.field("timestamp")
+        year = ds.field("year")
+        predicate = None
+
+        def add(condition):
+            nonlocal predicate
+            predicate = condition if predicate is None else predicate & condition
+
+        if parcel_id is not None:
+            add(ds.field("bucket") == int(parcel_id) % N_BUCKETS)
+            add(ds.field("parcel_id") == int(parcel_id))
+
+        if parcel_ids is not None:
+            parcel_ids = sorted({int(p) for p in parcel_ids})
+            add(ds.field("bucket").isin(sorted({p % N_BUCKETS for p in parcel_ids})))
+            add(ds.field("parcel_id").isin(parcel_ids))
+
+        if min_date is not None:
+            add(year >= min_date.year)
+            add(timestamp >= pa.scalar(min_date, pa.timestamp("us")))
+
+        if max_date is not None:
+            add(year <= max_date.year)
+            add(timestamp <= pa.scalar(max_date, pa.timestamp("us")))
+
+        if after is not None:
+            add(year >= after.year)
+            add(timestamp > pa.scalar(after, pa.timestamp("us")))
+
+        return predicate
+
+    def read(self, name, columns=None, **filters):
+        """Read a dataset, see ``_predicate`` for the filters"""
+        return (
+            self.dataset(name)
+            .to_table(columns=columns, filter=self._predicate(**filters))
+            .to_pandas()
+        )
+
+    def scan(self, name, columns=None, batch_size=65_536, **filters):
+        """Read a dataset as a stream of frames of at most ``batch_size`` rows
+
+        Only a few batches are in memory at a time. The rows are in file
+        order, not sorted.
+        """
+        batches = self.dataset(name).to_batches(
+            columns=columns, filter=self._predicate(**filters), batch_size=batch_size
+        )
+
+        for batch in batches:
+            if batch.num_rows:
+                yield batch.to_pandas()
+
+
+def main():
+    """Copy or refresh the replica, run it before starting the app"""
+    import argparse
+
+    from connect import get_db2_engine
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--root", default=os.environ.get("NITRATE_REPLICA_DIR", "replica")
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    added = Replica(args.root, get_db2_engine()).refresh_all()
+    logger.info("added %s", added)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from utils import add_color
+
+LATEST_MNLSO_QUERY = """
+    SELECT
+        m.MEETPUNT_CODE,
+        m.DATUM as timestamp,
+        m.WAARDE as value,
+        l.lat,
+        l.lon,
+        'MNLSO' as category
+    FROM MNLSO as m
+    INNER JOIN (
+        SELECT
+            MEETPUNT_CODE,
+            max(DATUM) as DATUM
+        FROM MNLSO
+        WHERE PARAMETER_CODE = 'NO3'
+        GROUP BY MEETPUNT_CODE
+    ) as r
+    ON m.MEETPUNT_CODE = r.MEETPUNT_CODE AND m.DATUM = r.DATUM
+    INNER JOIN LOCATIONS as l
+    ON l.MEETPUNT_CODE_IHW = m.MEETPUNT_CODE
+    WHERE m.PARAMETER_CODE = 'NO3'
+    """
+
+
+class RefreshedIndex:
+    """Base of the indexes below, ``refresh`` loads the state, which is loaded
+    again on the next lookup once it is older than ``refresh_interval``"""
+
+    def __init__(self, engine, refresh_interval):
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.loaded_at = None
+        self._state = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        raise NotImplementedError
+
+    def _stale(self):
+        loaded_at = self.loaded_at
+        return loaded_at is None or datetime.now() - loaded_at > self.refresh_interval
+
+    def _current(self):
+        if self._stale():
+            with self._lock:
+                # another session may have refreshed while we were waiting
+                if self._stale():
+                    self.refresh()
+
+        return self._state
+
+
+class StationIndex(RefreshedIndex):
+    """Latest NO3 value of every MNLSO station in a KD-tree on (lat, lon)
+
+    The stations are loaded with a single query and reloaded once they are
+    older than ``refresh_interval``, all lookups are answered from memory.
+    ``normalize`` is passed on to utils.add_color.
+    """
+
+    def __init__(self, engine, refresh_interval=timedelta(hours=6), normalize=None):
+        super().__init__(engine, refresh_interval)
+        self.normalize = normalize
+
+    def refresh(self):
+        with self.engine.connect() as connection:
+            stations = pd.read_sql(text(LATEST_MNLSO_QUERY), con=connection)
+
+        stations = (
+            stations.rename(columns=str.lower)
+            .assign(
+                lat=lambda f: pd.to_numeric(f.lat, errors="coerce"),
+                lon=lambda f: pd.to_numeric(f.lon, errors="coerce"),
+            )
+            .dropna()
+            .reset_index(drop=True)
+            .assign(timestamp=lambda f: pd.to_datetime(f.timestamp))
+            .pipe(add_color, packed=True, normalize=self.normalize)
+        )
+
+        from scipy.spatial import cKDTree
+
+        coordinates = stations[["lat", "lon"]].to_numpy(dtype=np.float64)
+        self._state = (stations, cKDTree(coordinates.reshape(-1, 2)))
+        self.loaded_at = datetime.now()
+
+    def within(self, lat, lon, thres):
+        """Stations with both |lat - lat0| and |lon - lon0| below ``thres``"""
+        stations, tree = self._current()
+
+        idx = np.sort(tree.query_ball_point([lat, lon], r=thres, p=np.inf))
+        found = stations.iloc[idx]
+
+        # the tree includes points on the boundary of the box, the query did not
+        inside = (np.abs(found.lat - lat) < thres) & (np.abs(found.lon - lon) < thres)
+        return found.loc[inside]
+
+    def nearest(self, lat, lon, k=1):
+        """The ``k`` stations closest to (lat, lon), nearest first"""
+        stations, tree = self._current()
+
+        k = min(k, len(stations))
+        if k == 0:
+            return stations.iloc[[]]
+
+        _, idx = tree.query([lat, lon], k=k)
+        return stations.iloc[np.atleast_1d(idx)]
+
+
+MNLSO_SERIES_QUERY = """
+    SELECT
+        meetpunt_code,
+        datum as timestamp,
+        groeiseizoen as season,
+        waarde as value
+    FROM MNLSO
+    WHERE parameter_code = 'NO3'
+    ORDER BY meetpunt_code, datum
+    """
+
+
+class SeriesIndex(RefreshedIndex):
+    """NO3 series of every MNLSO station, loaded with a single query
+
+    The rows are stored sorted by (station, time) in contiguous arrays, with
+    ``offsets[i]:offsets[i + 1]`` the rows of ``codes[i]``. A station is found
+    with a binary search on the codes and a time range with a binary search
+    within its rows. Reloaded once older than ``refresh_interval``.
+    """
+
+    def __init__(self, engine, refresh_interval=timedelta(hours=6)):
+        super().__init__(engine, refresh_interval)
+
+    def refresh(self):
+        with self.engine.connect() as connection:
+            series = pd.read_sql(text(MNLSO_SERIES_QUERY), con=connection)
+
+        series = (
+            series.rename(columns=str.lower)
+            .assign(
+                timestamp=lambda f: pd.to_datetime(f.timestamp),
+                value=lambda f: pd.to_numeric(f.value, errors="coerce"),
+            )
+            .dropna(subset=["meetpunt_code", "timestamp", "value"])
+            # the database collation may sort the codes differently
+            .sort_values(["meetpunt_code", "timestamp"], kind="stable")
+        )
+
+        codes, starts = np.unique(series.meetpunt_code.to_numpy(), return_index=True)
+
+        self._state = {
+            "codes": codes,
+            "offsets": np.append(starts, len(series)),
+            "timestamps": series.timestamp.to_numpy(),
+            "values": series.value.to_numpy(dtype=np.float64),
+            "seasons": series.season.to_numpy(),
+        }
+        self.loaded_at = datetime.now()
+
+    def _rows(self, state, code, after, until):
+        """Row range of a station, after (exclusive) and until (inclusive)"""
+        i = np.searchsorted(state["codes"], code)
+        if i == len(state["codes"]) or state["codes"][i] != code:
+            return 0, 0
+
+        start, end = state["offsets"][i], state["offsets"][i + 1]
+        timestamps = state["timestamps"][start:end]
+
+        if after is not None:
+            start += np.searchsorted(timestamps, np.datetime64(after), side="right")
+            timestamps = state["timestamps"][start:end]
+
+        if until is not None:
+            end = start + np.searchsorted(
+                timestamps, np.datetime64(until), side="right"
+            )
+
+        return start, end
+
+    def series(self, codes, after=None, until=None):
+        """Rows of the given stations, by station and time"""
+        state = self._current()
+
+        ranges = [self._rows(state, code, after, until) for code in sorted(set(codes))]
+        rows = np.concatenate(
+            [np.arange(start, end) for start, end in ranges] + [np.array([], dtype=int)]
+        )
+
+        lengths = [end - start for start, end in ranges]
+        return pd.DataFrame(
+            {
+                "timestamp": state["timestamps"][rows],
+                "season": state["seasons"][rows],
+                "value": state["values"][rows],
+                "meetpunt_code": np.repeat(sorted(set(codes)), lengths).astype(object),
+                "category": "MNLSO",
+            }
+        )
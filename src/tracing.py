@@ -0,0 +1,224 @@
+"""Timing of loaders and page sections
+
+Enable with TRACING=1. Every traced call becomes a span with its wall time,
+the rows and bytes it returned, whether the cache was hit, and the
+fingerprints and time of the SQL statements it ran. Spans are logged as one
+JSON object per line on the ``tracing`` logger and kept per session for the
+debug panel in the sidebar. When disabled, ``traced`` returns the function
+as is and ``span`` a shared no-op context manager.
+"""
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import pandas as pd
+
+ENABLED = os.environ.get("TRACING", "") not in ("", "0")
+
+# spans kept for the debug panel, per session and for this many sessions
+SPANS_PER_SESSION = 200
+MAX_SESSIONS = 100
+
+logger = logging.getLogger("tracing")
+
+_current = contextvars.ContextVar("span", default=None)
+_sessions = OrderedDict()
+_lock = threading.Lock()
+_noop = contextlib.nullcontext()
+
+
+def session_id():
+    """Id of the streamlit session of this thread, also in render-data threads"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:  # streamlit < 1.12
+        from streamlit.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+def result_size(value):
+    """(rows, bytes) of a loader result, None where it does not apply"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        size = value.memory_usage(deep=True)
+        return len(value), int(size.sum() if isinstance(size, pd.Series) else size)
+
+    if isinstance(value, (bytes, bytearray)):
+        return None, len(value)
+
+    if isinstance(value, (list, tuple, dict)):
+        return len(value), None
+
+    return None, None
+
+
+def fingerprint(statement):
+    """Hash of a SQL statement with its literals and whitespace normalized"""
+    normalized = statement.lower()
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", normalized)
+    normalized = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    # expanding IN lists differ in length per call
+    normalized = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", normalized)
+
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def note(**fields):
+    """Set fields on the innermost span of this thread, if any"""
+    current = _current.get()
+    if current is not None:
+        current.update(fields)
+
+
+def _record(record):
+    logger.info(json.dumps(record, default=str))
+
+    with _lock:
+        spans = _sessions.pop(record["session"], None)
+        if spans is None:
+            spans = deque(maxlen=SPANS_PER_SESSION)
+        _sessions[record["session"]] = spans
+        spans.append(record)
+
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last=False)
+
+
+@contextlib.contextmanager
+def _span(name, kind):
+    parent = _current.get()
+    record = {
+        "name": name,
+        "kind": kind,
+        "parent": parent["name"] if parent is not None else None,
+        "session": session_id(),
+        "started": time.time(),
+        "cache": None,
+        "sql": [],
+        "sql_seconds": 0.0,
+    }
+
+    token = _current.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        _current.reset(token)
+        _record(record)
+
+
+def span(name, kind="section"):
+    """Context manager that times a block, e.g. a containers section"""
+    if not ENABLED:
+        return _noop
+
+    return _span(name, kind)
+
+
+def traced(func=None, name=None, kind="loader"):
+    """Decorator that records a span for every call of the function"""
+    if func is None:
+        return functools.partial(traced, name=name, kind=kind)
+
+    if not ENABLED:
+        return func
+
+    span_name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _span(span_name, kind) as record:
+            value = func(*args, **kwargs)
+            record["rows"], record["bytes"] = result_size(value)
+            return value
+
+    return wrapper
+
+
+def instrument_engine(engine):
+    """Add the SQL statements run on the engine to the current span"""
+    if not ENABLED:
+        return engine
+
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("tracing_start", []).append(time.perf_counter())
+
+    def finish(conn, statement, error=None):
+        starts = conn.info.get("tracing_start")
+        if not starts:
+            return
+
+        seconds = time.perf_counter() - starts.pop()
+
+        current = _current.get()
+        if current is not None:
+            current["sql"].append(fingerprint(statement))
+            current["sql_seconds"] += seconds
+            if error is not None:
+                current["error"] = type(error).__name__
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        finish(conn, statement)
+
+    # after_cursor_execute does not fire for a statement that raised
+    @event.listens_for(engine, "handle_error")
+    def failed(context):
+        if context.connection is not None and context.statement is not None:
+            finish(context.connection, context.statement, context.original_exception)
+
+    return engine
+
+
+def session_spans(session=None):
+    """Recorded spans of a session, oldest first, as a dataframe"""
+    with _lock:
+        spans = list(_sessions.get(session or session_id(), []))
+
+    columns = [
+        "name",
+        "kind",
+        "parent",
+        "seconds",
+        "sql_seconds",
+        "rows",
+        "bytes",
+        "cache",
+        "started",
+        "sql",
+    ]
+    frame = pd.DataFrame(spans, columns=columns)
+
+    return frame.assign(
+        started=pd.to_datetime(frame.started, unit="s"),
+        sql=frame.sql.map(lambda s: ", ".join(dict.fromkeys(s or []))),
+    )
+
+
+def debug_panel(max_spans=50):
+    """Latest spans of this session in the sidebar, only when tracing is on"""
+    if not ENABLED:
+        return
+
+    import streamlit as st
+
+    with st.sidebar.expander("Tracing"):
+        spans = session_spans().tail(max_spans).iloc[::-1]
+        st.dataframe(spans.drop(columns="started"))
@@ -1,6 +1,7 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
-import matplotlib as mpl
-from scipy.stats import boxcox
 
 SURFACE_WATER = "surface water"
 GROUND_WATER = "ground water"
@@ -18,30 +19,76 @@ def map_category(category):
     return category_mappings.get(category.lower(), OTHER)
 
 
-def add_color(
+def boxcox(x, lambda_):
+    """Box-Cox transform with a fixed lambda, as scipy.stats.boxcox(x, lambda_)"""
+    if lambda_ == 0:
+        return np.log(x)
+
+    return np.expm1(lambda_ * np.log(x)) / lambda_
+
+
+def get_color_map(name="coolwarm"):
+    # matplotlib is only imported once the first colors are needed
+    import matplotlib as mpl
+
+    return mpl.colormaps[name]
+
+
+def get_rgba(
     df,
     lambda_=0.3,
     add_opacity=False,
-    color_map=mpl.colormaps["coolwarm"],
+    color_map=None,
+    normalize=None,
 ):
-    """Add color column to dataframe based on 'value' column"""
+    """Packed (n, 4) uint8 RGBA array based on 'value' column
 
-    if df.empty:
-        return df.assign(color=[])
+    ``normalize`` maps the values to [0, 1], e.g. to their global quantiles,
+    without it a Box-Cox transform with fixed bounds is used.
+    """
+    color_map = color_map or get_color_map()
+
+    if normalize is not None:
+        data_normed = np.clip(normalize(df.value.to_numpy()), 0, 1)
+    else:
+        data_normed = np.clip((boxcox(df.value.to_numpy(), lambda_) + 2) / 8, 0, 1)
 
-    data_normed = np.clip((boxcox(df.value, lambda_) + 2) / 8, 0, 1)
+    rgba = color_map(data_normed, bytes=True)
 
-    rgb_values = color_map(data_normed, bytes=True)
+    if add_opacity:
+        rgba[:, 3] = get_opacity(df)
 
-    if not add_opacity:
-        return df.assign(color=[x.tolist() for x in rgb_values])
+    return rgba
+
+
+def add_color(
+    df,
+    lambda_=0.3,
+    add_opacity=False,
+    color_map=None,
+    packed=False,
+    normalize=None,
+):
+    """Add color column to dataframe based on 'value' column
+
+    With ``packed`` the color is added as uint8 columns r, g, b and a, which
+    pydeck reads directly with the accessor "[r, g, b, a]".
+    """
+
+    if df.empty:
+        if packed:
+            empty = np.array([], dtype=np.uint8)
+            return df.assign(r=empty, g=empty, b=empty, a=empty)
+        return df.assign(color=[])
 
-    opacities = get_opacity(df)
+    rgba = get_rgba(
+        df, lambda_, add_opacity=add_opacity, color_map=color_map, normalize=normalize
+    )
 
-    for i, opacity in enumerate(opacities):
-        rgb_values[i, -1] = opacity
+    if packed:
+        return df.assign(r=rgba[:, 0], g=rgba[:, 1], b=rgba[:, 2], a=rgba[:, 3])
 
-    return df.assign(color=[x.tolist() for x in rgb_values])
+    return df.assign(color=rgba.tolist())
 
 
 def get_opacity(df):
@@ -49,13 +96,80 @@ def get_opacity(df):
     latest_time = df.timestamp.max()
 
     if earliest_time == latest_time:
-        return [
-            255,
-        ]
+        return np.full(len(df), 255, dtype=np.uint8)
 
     max_range = (latest_time - earliest_time).total_seconds()
+    elapsed = (df.timestamp - earliest_time).dt.total_seconds().to_numpy()
+
+    return ((elapsed / max_range) ** 0.25 * 255).astype(np.uint8)
+
+
+def lttb(x, y, n_out):
+    """Indices of the points kept by Largest-Triangle-Three-Buckets
+
+    Downsamples (x, y) to ``n_out`` points while keeping the visual shape of
+    the line, the first and last point are always kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # n_out - 2 buckets between the fixed first and last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+
+        avg_x = x[hi:next_hi].mean()
+        avg_y = y[hi:next_hi].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return keep
+
+
+def downsample(df, max_points, x="timestamp", y="value"):
+    """Reduce a frame to at most ``max_points`` rows with lttb"""
+    if len(df) <= max_points:
+        return df
+
+    x_values = df[x].to_numpy()
+    if np.issubdtype(x_values.dtype, np.datetime64):
+        x_values = x_values.astype("datetime64[ns]").astype(np.int64)
+
+    return df.iloc[lttb(x_values, df[y].to_numpy(), max_points)]
+
+
+class LRUCache:
+    """Bounded, thread-safe least-recently-used cache"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        value = build()
+
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
 
-    return [
-        int((((x - earliest_time).total_seconds() / max_range) ** 0.25) * 255)
-        for x in df.timestamp
-    ]
+        return value
@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import loaders
+import containers
+
+logger = logging.getLogger(__name__)
+
+WARMUP_PARCELS = int(os.environ.get("WARMUP_PARCELS", 50))
+WARMUP_WORKERS = int(os.environ.get("WARMUP_WORKERS", 2))
+WARMUP_SECONDS = float(os.environ.get("WARMUP_SECONDS", 300))
+
+# the sidebar defaults, which is what the first visitor will see
+DEFAULT_LOOKBACK_DAYS = 14
+DEFAULT_MIN_MEAS = 5
+
+
+def top_parcels(n, min_date, max_date):
+    """The n parcels with the most measurements in the window"""
+    user_counts = loaders.get_user_ids(min_date, max_date, min_meas=0)
+    return user_counts.counts.nlargest(n).index.tolist()
+
+
+def warm_parcel(userid, min_date, max_date):
+    user_meas = loaders.get_user_measurements(userid, min_date, max_date)
+    loaders.get_parcel_data(userid)
+
+    if not user_meas.empty:
+        loaders.get_locations(user_meas.latitude.mean(), user_meas.longitude.mean())
+
+    # the first layers a visitor typically switches on
+    temperature = (containers.MIN_TEMP_LAYER, containers.MAX_TEMP_LAYER)
+    for layers in [("Precip past 1 h",), temperature]:
+        loaders.get_weather_data(
+            userid,
+            min_date,
+            max_date,
+            layers=layers,
+            max_points=containers.PLOT_POINTS,
+        )
+
+
+def warm_up(
+    n_parcels=WARMUP_PARCELS,
+    max_workers=WARMUP_WORKERS,
+    budget_seconds=WARMUP_SECONDS,
+):
+    """Fill the caches for the default view of the most active parcels
+
+    Uses at most ``max_workers`` threads so live sessions keep most of the
+    database connections, and stops starting new parcels once
+    ``budget_seconds`` have passed.
+    """
+    deadline = time.monotonic() + budget_seconds
+
+    max_date = containers.MAX_DATE
+    min_date = max_date - timedelta(days=DEFAULT_LOOKBACK_DAYS)
+
+    loaders.get_usage_dates(
+        lookback_days=DEFAULT_LOOKBACK_DAYS, min_meas=DEFAULT_MIN_MEAS
+    )
+    loaders.get_weather_layers()
+
+    parcels = top_parcels(n_parcels, min_date, max_date)
+
+    def warm(userid):
+        if time.monotonic() > deadline:
+            return False
+
+        try:
+            warm_parcel(userid, min_date, max_date)
+        except Exception:
+            logger.exception("warm-up of parcel %s failed", userid)
+            return False
+
+        return True
+
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="warmup") as pool:
+        warmed = sum(pool.map(warm, parcels))
+
+    logger.info("warmed up %d of %d parcels", warmed, len(parcels))
+    return warmed
+
+
+def start():
+    """Run the first copy of the replica and the first parcel sync, if they
+    are missing, and the warm-up in a background thread, returns the thread"""
+    replica = loaders.get_replica()
+    parcel_store = loaders.get_parcel_store()
+
+    def run():
+        try:
+            if not replica.initialized:
+                replica.refresh_all()
+                logger.info("copied the replica")
+
+            if not parcel_store.initialized:
+                parcel_store.sync(loaders.get_cloudant_connection()["parcels"])
+                logger.info("synced the parcel store")
+
+            if WARMUP_PARCELS > 0:
+                warm_up()
+        except Exception:
+            logger.exception("warm-up failed")
+
+    thread = threading.Thread(target=run, name="warmup", daemon=True)
+
+    if WARMUP_PARCELS > 0 or not (replica.initialized and parcel_store.initialized):
+        thread.start()
+
+    return thread
@@ -1,11 +1,16 @@
 import connect
 import streamlit as st
-import requests
-from datetime import timedelta
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, datetime
 from operator import methodcaller
 import math
 
-import ibmpairs.query as query
+import pandas as pd
+
+import tracing
 
 layers = [
     {"id": "49250"},  # yes
@@ -16,8 +21,34 @@ layers = [
     # {"id": "49249"},
 ]
 
+# names the layers are stored under in WEATHERDATA, the weather panel
+# selects them by name
+LAYER_NAMES = {
+    49250: "Precip past 1 h",
+    49309: "Maximum temperature past 24 h",
+    49308: "Minimum temperature past 24 h",
+}
+
 date_to_str = methodcaller("strftime", "%Y-%m-%dT%H:%M:%SZ")
 
+# roughly the 4 km resolution of the TWC layers, points in the same cell
+# get the same values so they only have to be fetched once
+GRID_DEGREES = 0.04
+
+# requested ranges are split into fixed tiles, aligned to TILE_ORIGIN, so
+# overlapping ranges of different users share the same tiles
+TILE_ORIGIN = datetime(year=2000, month=1, day=1)
+TILE_SIZE = timedelta(days=30)
+
+MAX_POINTS_PER_QUERY = 50
+MAX_CACHED_TILES = 50_000
+
+# seconds a fetched tile is served from memory. A tile that ended less than
+# SETTLE_TIME ago can still get data, as can one EIS returned empty
+TILE_TTL = 7 * 24 * 3600
+OPEN_TILE_TTL = 3600
+SETTLE_TIME = timedelta(days=2)
+
 
 def get_days_between(start_date, end_date, delta=timedelta(days=1)):
     cur = start_date
@@ -40,18 +71,195 @@ def get_intervals(start_date, end_date, max_points=30):
     return [{"snapshot": date_to_str(d)} for d in days]
 
 
-@st.cache
+def snap(lat, lon, grid=GRID_DEGREES):
+    """Centre of the grid cell containing (lat, lon)"""
+    return (
+        round((math.floor(lat / grid) + 0.5) * grid, 6),
+        round((math.floor(lon / grid) + 0.5) * grid, 6),
+    )
+
+
+def get_tiles(start_date, end_date):
+    """Start of every tile overlapping [start_date, end_date]"""
+    first = (start_date - TILE_ORIGIN) // TILE_SIZE
+    last = (end_date - TILE_ORIGIN) // TILE_SIZE
+
+    return [TILE_ORIGIN + i * TILE_SIZE for i in range(first, last + 1)]
+
+
+class RateLimiter:
+    """Spaces calls at least 1 / rate seconds apart, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+
+        time.sleep(max(0.0, slot - now))
+
+
+@tracing.traced(kind="eis")
+def submit_query(query_json):
+    import ibmpairs.query as query
+
+    return query.submit(query_json, client=get_eis_client()).point_data_as_dataframe()
+
+
+class WeatherFetcher:
+    """Point weather data from EIS, fetched per (grid cell, time tile)
+
+    Tiles that were fetched before are served from memory until they expire,
+    see ``TILE_TTL``, the least recently used ones are dropped beyond
+    ``max_tiles``. The missing ones are grouped into multi-point queries per
+    tile which run concurrently under a rate limit. ``submit`` takes a query
+    json and returns the point data as a dataframe, replace it to run against
+    a mock of the EIS API.
+    """
+
+    def __init__(
+        self,
+        submit=submit_query,
+        max_workers=4,
+        rate=2.0,
+        max_points=MAX_POINTS_PER_QUERY,
+        max_tiles=MAX_CACHED_TILES,
+    ):
+        self.submit = submit
+        self.max_points = max_points
+        self.max_tiles = max_tiles
+        self._limiter = RateLimiter(rate)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fetch_tile(self, cells, tile):
+        query_json = {
+            "layers": layers,
+            "spatial": {
+                "type": "point",
+                "coordinates": [f"{c}" for cell in cells for c in cell],
+            },
+            "temporal": {"intervals": get_intervals(tile, tile + TILE_SIZE)},
+        }
+
+        self._limiter.wait()
+        data = normalize(self.submit(query_json))
+
+        keys = [snap(lat, lon) for lat, lon in zip(data.latitude, data.longitude)]
+        by_cell = dict(tuple(data.groupby(pd.Series(keys, index=data.index))))
+
+        settled = tile + TILE_SIZE + SETTLE_TIME < datetime.utcnow()
+        now = time.monotonic()
+
+        with self._lock:
+            for cell in cells:
+                cell_data = by_cell.get(cell, data.iloc[:0])
+                ttl = TILE_TTL if settled and not cell_data.empty else OPEN_TILE_TTL
+
+                self._tiles[cell, tile] = (now + ttl, cell_data)
+                self._tiles.move_to_end((cell, tile))
+
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+    def _cached(self, cell, tile, now):
+        """Data of a cached (cell, tile), None when it is missing or expired
+
+        A hit moves the tile to the end, so the eviction drops the least
+        recently used tiles. Call it with the lock held.
+        """
+        item = self._tiles.get((cell, tile))
+        if item is None or item[0] < now:
+            return None
+
+        self._tiles.move_to_end((cell, tile))
+        return item[1]
+
+    def prefetch(self, cells, tiles):
+        """Fetch every (cell, tile) that is not cached yet or expired"""
+        now = time.monotonic()
+
+        with self._lock:
+            missing = {
+                tile: [cell for cell in cells if self._cached(cell, tile, now) is None]
+                for tile in tiles
+            }
+
+        futures = [
+            self._executor.submit(
+                self._fetch_tile, pending[i : i + self.max_points], tile
+            )
+            for tile, pending in missing.items()
+            for i in range(0, len(pending), self.max_points)
+        ]
+
+        for future in futures:
+            future.result()
+
+    def fetch_cells(self, cells, tiles):
+        """All data of the given cells and tiles, with the cell as columns"""
+        self.prefetch(cells, tiles)
+
+        # a tile that expired in between is served once more
+        with self._lock:
+            frames = []
+            for cell in cells:
+                for tile in tiles:
+                    if (cell, tile) not in self._tiles:
+                        continue
+
+                    self._tiles.move_to_end((cell, tile))
+                    frames.append(
+                        self._tiles[cell, tile][1].assign(
+                            cell_lat=cell[0], cell_lon=cell[1]
+                        )
+                    )
+
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def fetch(self, points, start_date, end_date):
+        """Weather for every (lat, lon) in points, with the snapped cell added"""
+        cells = sorted({snap(lat, lon) for lat, lon in points})
+        data = self.fetch_cells(cells, get_tiles(start_date, end_date))
+
+        if data.empty:
+            return data
+
+        # the last snapshot of a tile is also the first one of the next tile
+        return (
+            data.loc[(data.timestamp >= start_date) & (data.timestamp <= end_date)]
+            .drop_duplicates(["cell_lat", "cell_lon", "layer_id", "timestamp"])
+            .reset_index(drop=True)
+        )
+
+
+def normalize(data):
+    """Point data with a layer_id column and naive UTC timestamps"""
+    data = data.rename(columns={"layerId": "layer_id"})
+
+    if pd.api.types.is_numeric_dtype(data.timestamp):
+        timestamp = pd.to_datetime(data.timestamp, unit="ms")
+    else:
+        timestamp = pd.to_datetime(data.timestamp, utc=True).dt.tz_localize(None)
+
+    return data.assign(timestamp=timestamp)
+
+
+@st.experimental_singleton
+def get_eis_client():
+    return connect.get_eis_client()
+
+
+@st.experimental_singleton
+def get_fetcher():
+    return WeatherFetcher()
+
+
 def get_weather_data(lat, lon, start_date, end_date):
-    client = connect.get_eis_client()
-
-    query_json = {
-        "layers": layers,
-        "spatial": {
-            "type": "point",
-            "coordinates": [f"{lat}", f"{lon}"],
-        },
-        "temporal": {"intervals": get_intervals(start_date, end_date)},
-    }
-
-    query_res = query.submit(query_json)
-    return query_res.point_data_as_dataframe()
+    return get_fetcher().fetch([(lat, lon)], start_date, end_date)
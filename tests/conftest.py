@@ -0,0 +1,40 @@
+import os
+import shutil
+import sys
+
+import pytest
+import streamlit as st
+from sqlalchemy import create_engine
+
+REPO = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(REPO, "src"))
+sys.path.insert(0, os.path.join(REPO, "benchmarks"))
+
+# renamed in newer streamlit releases, the app modules use the old name
+if not hasattr(st, "experimental_singleton"):
+    st.experimental_singleton = st.cache_resource
+
+import synthetic  # noqa: E402
+
+ROWS = 2_000
+
+
+@pytest.fixture(scope="session")
+def synthetic_data(tmp_path_factory):
+    """Paths of db.sqlite and parcels.jsonl, generated once per session"""
+    return synthetic.generate(str(tmp_path_factory.mktemp("synthetic")), ROWS)
+
+
+@pytest.fixture
+def db_path(synthetic_data, tmp_path):
+    """A copy of the synthetic database the test is free to change"""
+    path = str(tmp_path / "db.sqlite")
+    shutil.copy(synthetic_data[0], path)
+    return path
+
+
+@pytest.fixture
+def engine(db_path):
+    engine = create_engine(f"sqlite:///{db_path}")
+    yield engine
+    engine.dispose()
@@ -0,0 +1,132 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+from counts import DailyCounts
+from replica import Replica
+
+# the queries the counts replace, on the database itself
+USER_COUNTS_QUERY = """
+    SELECT
+        m.parcel_id as userid,
+        count(*) as counts
+    FROM NITRATEAPP as n
+    INNER JOIN NITRATE_ID_MAPPING as m
+    ON n.id = m.nitrate_id
+    WHERE
+        n."timestamp" >= :min_date AND
+        n."timestamp" < :max_date
+    GROUP BY m.parcel_id
+    """
+
+ACTIVE_USERS_QUERY = """
+    SELECT
+        bucket,
+        count(*) as active
+    FROM (
+        SELECT
+            CAST(julianday(date(n."timestamp")) - julianday(:start) AS INTEGER)
+                / :lookback_days as bucket,
+            m.parcel_id
+        FROM NITRATEAPP as n
+        INNER JOIN NITRATE_ID_MAPPING as m
+        ON n.id = m.nitrate_id
+        GROUP BY bucket, m.parcel_id
+        HAVING count(*) > :min_meas
+    )
+    GROUP BY bucket
+    """
+
+
+@pytest.fixture
+def daily_counts(engine, tmp_path):
+    replica = Replica(str(tmp_path / "replica"), engine)
+    replica.refresh_all()
+
+    daily_counts = DailyCounts()
+    daily_counts.sync(replica)
+    return daily_counts
+
+
+@pytest.mark.parametrize(
+    "min_date, max_date",
+    [
+        (datetime(2017, 1, 1), datetime(2023, 1, 1)),
+        (datetime(2019, 3, 14), datetime(2019, 9, 2)),
+        (datetime(2020, 6, 1), datetime(2020, 6, 2)),
+        (datetime(2030, 1, 1), datetime(2031, 1, 1)),
+    ],
+)
+def test_window_counts(daily_counts, engine, min_date, max_date):
+    rows = pd.read_sql(
+        text(USER_COUNTS_QUERY),
+        engine,
+        params={"min_date": f"{min_date:%Y-%m-%d}", "max_date": f"{max_date:%Y-%m-%d}"},
+    )
+    expected = rows.set_index("userid").counts
+
+    counts = daily_counts.window_counts(min_date, max_date)
+
+    pd.testing.assert_series_equal(
+        counts.loc[counts > 0].sort_index(),
+        expected.sort_index(),
+        check_dtype=False,
+        check_names=False,
+        check_index_type=False,
+    )
+
+
+@pytest.mark.parametrize("lookback_days, min_meas", [(1, 0), (30, 3), (365, 10)])
+def test_active_users(daily_counts, engine, lookback_days, min_meas):
+    active = daily_counts.active_users(lookback_days, min_meas)
+
+    start = active.index[0]
+    rows = pd.read_sql(
+        text(ACTIVE_USERS_QUERY),
+        engine,
+        params={
+            "start": f"{start:%Y-%m-%d}",
+            "lookback_days": lookback_days,
+            "min_meas": min_meas,
+        },
+    )
+    expected = rows.set_index("bucket").active.reindex(
+        np.arange(len(active)), fill_value=0
+    )
+
+    assert start == daily_counts.counts.day.min()
+    np.testing.assert_array_equal(active.to_numpy(), expected.to_numpy())
+
+
+def test_active_users_follow_updates(daily_counts):
+    before = daily_counts.active_users(30, 0)
+    n_active = before.sum()
+
+    # the memoized result is not shared with the caller
+    before.iloc[:] = -1
+    assert daily_counts.active_users(30, 0).sum() == n_active
+
+    day = daily_counts.counts.day.max() + pd.Timedelta(days=1)
+    daily_counts.update(
+        pd.DataFrame({"parcel_id": [10**6], "timestamp": [day + pd.Timedelta(hours=1)]})
+    )
+
+    assert daily_counts.active_users(30, 0).sum() == n_active + 1
+    assert daily_counts.window_counts(day, day + pd.Timedelta(days=1)).loc[10**6] == 1
+
+
+def test_sync_skips_an_unchanged_replica(engine, tmp_path, monkeypatch):
+    replica = Replica(str(tmp_path / "replica"), engine)
+    replica.refresh_all()
+
+    daily_counts = DailyCounts()
+    daily_counts.sync(replica)
+
+    def read(*args, **kwargs):
+        raise AssertionError("scanned the replica")
+
+    monkeypatch.setattr(replica, "read", read)
+    daily_counts.sync(replica)
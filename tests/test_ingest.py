@@ -0,0 +1,128 @@
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+import ingest
+import weather
+from replica import Replica
+from synthetic import MockEis
+
+LAYERS = [49250, 49308, 49309]
+
+
+@pytest.fixture
+def parcels():
+    return pd.DataFrame(
+        {
+            "lat": [52.1, 52.5],
+            "lon": [5.1, 5.5],
+            "first": pd.to_datetime(["2021-06-03 10:00", "2021-09-20 08:00"]),
+            "last": pd.to_datetime(["2021-08-15 16:00", "2021-09-21 09:00"]),
+        },
+        index=pd.Index([1, 2], name="userid"),
+    )
+
+
+def full_coverage(parcels, layers=LAYERS):
+    """A row for every layer and day in the window of every parcel"""
+    rows = [
+        (userid, layer_id, day)
+        for userid, parcel in parcels.iterrows()
+        for day in pd.date_range(
+            (parcel["first"] - ingest.LOOKBACK).floor("D"), parcel["last"].floor("D")
+        )
+        for layer_id in layers
+    ]
+    return pd.DataFrame(rows, columns=["userid", "layer_id", "day"])
+
+
+def tiles(parcel):
+    return weather.get_tiles(parcel["first"] - ingest.LOOKBACK, parcel["last"])
+
+
+def test_no_gaps_when_covered(parcels):
+    assert ingest.find_gaps(parcels, full_coverage(parcels), len(LAYERS)) == {}
+
+
+def test_every_tile_is_missing_without_coverage(parcels):
+    coverage = full_coverage(parcels).iloc[:0]
+
+    gaps = ingest.find_gaps(parcels, coverage, len(LAYERS))
+
+    expected = {}
+    for userid, parcel in parcels.iterrows():
+        for tile in tiles(parcel):
+            expected.setdefault(tile, []).append(userid)
+    assert gaps == expected
+
+
+def test_a_missing_day_of_one_layer(parcels):
+    coverage = full_coverage(parcels)
+    day = pd.Timestamp("2021-07-01")
+    missing = (coverage.userid == 1) & (coverage.layer_id == 49308)
+
+    gaps = ingest.find_gaps(
+        parcels, coverage.loc[~(missing & (coverage.day == day))], len(LAYERS)
+    )
+
+    assert gaps == {ingest.tile_of(pd.Series([day]))[0]: [1]}
+
+
+def test_days_outside_the_window_do_not_count(parcels):
+    coverage = full_coverage(parcels)
+    last = parcels.loc[2, "last"].floor("D")
+    tile = ingest.tile_of(pd.Series([last]))[0]
+    assert tile + weather.TILE_SIZE > last + timedelta(days=1)
+
+    # a missing day in the window, made up for by a day after it in the tile
+    coverage = pd.concat(
+        [
+            coverage.loc[(coverage.userid != 2) | (coverage.day != last)],
+            pd.DataFrame(
+                {
+                    "userid": 2,
+                    "layer_id": LAYERS,
+                    "day": last + timedelta(days=1),
+                }
+            ),
+        ],
+        ignore_index=True,
+    )
+
+    assert ingest.find_gaps(parcels, coverage, len(LAYERS)) == {tile: [2]}
+
+
+def test_tile_of_matches_get_tiles():
+    days = pd.Series(pd.date_range("2020-12-01", "2021-03-01"))
+
+    for day, tile in zip(days, ingest.tile_of(days)):
+        assert weather.get_tiles(day, day) == [tile]
+
+
+def test_n_expected_days():
+    tile = weather.TILE_ORIGIN + 10 * weather.TILE_SIZE
+    start = pd.Timestamp(tile + timedelta(days=3, hours=5))
+
+    assert ingest.n_expected_days(tile, start, start + timedelta(days=100)) == 27
+    assert ingest.n_expected_days(tile, start, start) == 1
+    assert ingest.n_expected_days(tile, start - timedelta(days=40), start) == 4
+
+    before = pd.Timestamp(tile - timedelta(days=90))
+    assert ingest.n_expected_days(tile, before, before + timedelta(days=30)) == 0
+
+
+def test_run_fills_every_gap(engine, tmp_path):
+    replica = Replica(str(tmp_path / "replica"), engine)
+    checkpoint = str(tmp_path / "checkpoint.json")
+
+    def run():
+        eis = MockEis()
+        fetcher = weather.WeatherFetcher(eis, rate=1000)
+        ingest.run(engine, replica, checkpoint, fetcher=fetcher)
+        return eis.queries
+
+    assert run()
+
+    # everything is stored now, so another run has nothing to fetch
+    assert not run()
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+from replica import DATASETS, START_WATERMARK, Replica
+
+
+def expected(engine, name):
+    """Rows of a dataset straight from the database"""
+    query = text(DATASETS[name]["query"])
+    frame = pd.read_sql(query, engine, params={"watermark": START_WATERMARK})
+    return frame.rename(columns=str.lower)
+
+
+def add_measurement(db_path, nitrate_id, timestamp):
+    """Copy the latest measurement under a new id and the given timestamp"""
+    with sqlite3.connect(db_path) as connection:
+        row = connection.execute(
+            'SELECT * FROM NITRATEAPP_NL_WITH_LOC_ID ORDER BY "timestamp" DESC'
+        ).fetchone()
+        row = (nitrate_id, row[1], timestamp, *row[3:])
+
+        values = ", ".join("?" * len(row))
+        connection.execute(
+            f"INSERT INTO NITRATEAPP_NL_WITH_LOC_ID VALUES ({values})", row
+        )
+        connection.execute(
+            "INSERT INTO NITRATEAPP VALUES (?, ?, ?)", (nitrate_id, timestamp, row[3])
+        )
+        connection.execute(
+            "INSERT INTO NITRATE_ID_MAPPING VALUES (?, ?)", (nitrate_id, row[1])
+        )
+
+
+@pytest.fixture
+def replica(engine, tmp_path):
+    return Replica(str(tmp_path / "replica"), engine, chunksize=500)
+
+
+def test_refresh_copies_every_row(replica, engine):
+    added = replica.refresh_all()
+
+    for name in DATASETS:
+        rows = expected(engine, name)
+        copied = replica.read(name)
+
+        assert added[name] == len(rows)
+        assert sorted(copied.id) == sorted(rows.id)
+        assert replica.watermark(name) == pd.to_datetime(rows.timestamp).max()
+
+    assert replica.initialized
+
+
+def test_refresh_again_adds_nothing(replica):
+    replica.refresh_all()
+    watermarks = {name: replica.watermark(name) for name in DATASETS}
+
+    assert replica.refresh_all() == {name: 0 for name in DATASETS}
+    assert {name: replica.watermark(name) for name in DATASETS} == watermarks
+
+
+def test_refresh_adds_rows_at_the_watermark(replica, db_path):
+    replica.refresh_all()
+    watermark = replica.watermark("nitrate")
+
+    add_measurement(db_path, 10**6, watermark.strftime("%Y-%m-%d %H:%M:%S"))
+
+    assert replica.refresh_all() == {"nitrate": 1, "measurements": 1}
+    assert replica.read("nitrate").id.is_unique
+    assert replica.watermark("nitrate") == watermark
+
+
+def test_copied_ids_are_skipped(replica, engine):
+    replica.refresh_all()
+
+    # as left behind by a refresh that copied rows without moving the watermark
+    for name in DATASETS:
+        replica._set_watermark(name, START_WATERMARK)
+
+    assert replica.refresh_all() == {name: 0 for name in DATASETS}
+    assert len(replica.read("nitrate")) == len(expected(engine, "nitrate"))
+
+
+def test_failed_commit_leaves_the_dataset_unchanged(replica, engine, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(replica, "_commit", fail)
+    with pytest.raises(RuntimeError):
+        replica.refresh("nitrate")
+
+    assert replica.read("nitrate").empty
+    assert replica.watermark("nitrate") == START_WATERMARK
+
+    # the staged rows without a commit are dropped by the next refresh
+    monkeypatch.undo()
+    assert replica.refresh("nitrate") == len(expected(engine, "nitrate"))
+    assert replica.read("nitrate").id.is_unique
+    assert not os.listdir(replica._staging_path("nitrate"))
+
+
+def test_interrupted_commit_is_completed(replica, engine, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(replica, "_apply", fail)
+    with pytest.raises(RuntimeError):
+        replica.refresh("nitrate")
+
+    assert replica.read("nitrate").empty
+
+    # the commit was recorded, so the recovery moves the staged rows in
+    monkeypatch.undo()
+    assert replica.refresh("nitrate") == 0
+
+    rows = expected(engine, "nitrate")
+    assert sorted(replica.read("nitrate").id) == sorted(rows.id)
+    assert replica.watermark("nitrate") == pd.to_datetime(rows.timestamp).max()
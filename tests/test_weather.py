@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import weather
+from synthetic import MockEis
+
+START = datetime(2021, 3, 10)
+END = datetime(2021, 4, 20)
+
+
+@pytest.fixture
+def eis():
+    return MockEis()
+
+
+@pytest.fixture
+def fetcher(eis):
+    return weather.WeatherFetcher(submit=eis, rate=1000)
+
+
+def test_fetch_returns_every_day_of_the_range(fetcher):
+    data = fetcher.fetch([(52.1, 5.1)], START, END)
+
+    days = (END - START).days + 1
+    assert len(data) == days * len(weather.layers)
+    assert data.timestamp.min() == START
+    assert data.timestamp.max() == END
+    assert set(zip(data.cell_lat, data.cell_lon)) == {weather.snap(52.1, 5.1)}
+
+
+def test_tiles_are_fetched_once(fetcher, eis):
+    fetcher.fetch([(52.1, 5.1)], START, END)
+    n_queries = len(eis.queries)
+
+    # a range within the same tiles is served from memory
+    data = fetcher.fetch([(52.1, 5.1)], START + timedelta(days=5), END)
+
+    assert len(eis.queries) == n_queries == len(weather.get_tiles(START, END))
+    assert data.timestamp.min() == START + timedelta(days=5)
+
+
+def test_points_in_one_cell_share_a_query(fetcher, eis):
+    fetcher.fetch([(52.101, 5.101), (52.102, 5.102)], START, START)
+
+    (query,) = eis.queries
+    assert len(query["spatial"]["coordinates"]) == 2
+
+
+def test_cells_are_split_over_queries(eis):
+    fetcher = weather.WeatherFetcher(submit=eis, rate=1000, max_points=2)
+    points = [(52.0 + i * 0.1, 5.0) for i in range(5)]
+
+    data = fetcher.fetch(points, START, START)
+
+    assert len(eis.queries) == 3
+    assert len(set(zip(data.cell_lat, data.cell_lon))) == 5
+
+
+def test_recent_tiles_expire_sooner(fetcher):
+    recent = datetime.utcnow() - timedelta(days=1)
+    fetcher.fetch([(52.1, 5.1)], START, START)
+    fetcher.fetch([(52.1, 5.1)], recent, recent)
+
+    (settled, _), (open_, _) = fetcher._tiles.values()
+    assert settled - open_ == pytest.approx(
+        weather.TILE_TTL - weather.OPEN_TILE_TTL, abs=60
+    )
+
+
+def test_least_recently_used_tiles_are_dropped(eis):
+    fetcher = weather.WeatherFetcher(submit=eis, rate=1000, max_tiles=2)
+    first, second, third = [(52.0 + i, 5.0) for i in range(3)]
+
+    fetcher.fetch([first], START, START)
+    fetcher.fetch([second], START, START)
+    fetcher.fetch([first], START, START)
+    fetcher.fetch([third], START, START)
+
+    cells = {cell for cell, _ in fetcher._tiles}
+    assert cells == {weather.snap(*first), weather.snap(*third)}
+    assert len(eis.queries) == 3